@@ -0,0 +1,171 @@
+import asyncio
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+
+import main
+
+# ASGI serving mode: uvicorn asgi:app --port 5000
+# Webhooks are coroutines, not threads: classification / Neo4j work runs on a bounded executor and the
+# LINE replies go out over one shared aiohttp connection pool, so thousands of webhooks can be in flight.
+#
+# Neo4j stays on the sync driver inside the executor on purpose, even though the neo4j package ships
+# AsyncGraphDatabase: every handler interleaves graph reads with encoder / classifier calls that are
+# CPU-bound and must run on a thread anyway, so an async driver would only add an await hop per query
+# and a second, async copy of every handler next to the one Flask uses. The driver releases the GIL
+# while it waits on the socket, and chat history (most of the writes) is already batched off the reply
+# path. INFERENCE_WORKERS therefore bounds concurrent Neo4j sessions and should not exceed NEO4J_POOL_SIZE.
+INFERENCE_WORKERS = int(os.environ.get('INFERENCE_WORKERS', str(main.WEBHOOK_WORKERS)))
+SHUTDOWN_DRAIN_SECONDS = 10.0
+
+if INFERENCE_WORKERS > main.NEO4J_POOL_SIZE:
+    print(f"INFERENCE_WORKERS ({INFERENCE_WORKERS}) > NEO4J_POOL_SIZE ({main.NEO4J_POOL_SIZE}): "
+          f"workers will queue for Neo4j connections")
+
+inference_executor = ThreadPoolExecutor(max_workers=INFERENCE_WORKERS, thread_name_prefix='inference')
+
+class AsyncLineReplier:
+    """Reply API client on a keep-alive aiohttp session (opened in the lifespan startup)"""
+    def __init__(self, access_token=main.LINE_CHANNEL_ACCESS_TOKEN, endpoint=main.LINE_API_ENDPOINT):
+        self.url = endpoint.rstrip('/') + '/v2/bot/message/reply'
+        self.headers = {'Authorization': 'Bearer ' + access_token, 'Content-Type': 'application/json'}
+        self.session = None
+
+    async def open(self):
+        connector = aiohttp.TCPConnector(limit=main.LINE_HTTP_POOL_SIZE)
+        self.session = aiohttp.ClientSession(connector=connector,
+                                             timeout=aiohttp.ClientTimeout(total=main.LINE_HTTP_TIMEOUT))
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+
+    async def reply_message(self, reply_token, messages):
+        payload = {'replyToken': reply_token, 'messages': [message.as_json_dict() for message in messages]}
+        async with self.session.post(self.url, headers=self.headers,
+                                     data=json.dumps(payload, ensure_ascii=False).encode('utf-8')) as response:
+            if response.status != 200:
+                print(f"LINE reply failed ({response.status}): {await response.text()}")
+
+class AsyncEventDispatcher:
+    """Runs each user's events one after another; different users run concurrently"""
+    def __init__(self):
+        self._tails = {}  # user key -> task of that user's latest event
+        self._tasks = set()
+
+    def submit(self, user_key, event):
+        task = asyncio.ensure_future(self._run_after(self._tails.get(user_key), event))
+        self._tails[user_key] = task
+        self._tasks.add(task)
+        task.add_done_callback(lambda done: self._forget(user_key, done))
+
+    def _forget(self, user_key, task):
+        self._tasks.discard(task)
+        if self._tails.get(user_key) is task:
+            del self._tails[user_key]
+
+    async def _run_after(self, previous, event):
+        if previous is not None:
+            await asyncio.wait([previous])
+        try:
+            await handle_event(event)
+        except Exception as e:
+            print(f"Webhook event error for {main.event_user_key(event)}: {e}")
+
+    def pending(self):
+        return len(self._tasks)
+
+    async def drain(self, timeout):
+        if self._tasks:
+            await asyncio.wait(list(self._tasks), timeout=timeout)
+
+line_replier = AsyncLineReplier()
+async_dispatcher = AsyncEventDispatcher()
+
+async def handle_event(event):
+    # The handlers only record their replies here; the HTTP call happens on the event loop
+    recorder = main.ReplyRecorder()
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(inference_executor, main.handle_webhook_event, recorder, event)
+    for reply_token, messages in recorder.replies:
+        await line_replier.reply_message(reply_token, messages)
+
+async def read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+async def send_response(send, status, body, content_type='application/json'):
+    if not isinstance(body, bytes):
+        body = json.dumps(body, ensure_ascii=False).encode('utf-8')
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type.encode()), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+async def webhook(body, headers):
+    text = body.decode('utf-8')
+    if not main.valid_signature(text, headers.get('x-line-signature', '')):
+        print("Webhook rejected: invalid X-Line-Signature")
+        return 400, b'Invalid signature'
+    try:
+        for event in json.loads(text).get('events', []):
+            async_dispatcher.submit(main.event_user_key(event), event)
+    except Exception as e:
+        print(f"Webhook error: {e}")
+    return 200, b'OK'
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            main.start_background_init()
+            await line_replier.open()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await async_dispatcher.drain(SHUTDOWN_DRAIN_SECONDS)
+            await line_replier.close()
+            inference_executor.shutdown(wait=True)
+            main.chat_history_writer.close()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+        return
+    if scope['type'] != 'http':
+        return
+
+    method, path = scope['method'], scope['path']
+    headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+    body = await read_body(receive)
+    main.start_background_init()
+
+    if method == 'POST' and path == '/':
+        status, text = await webhook(body, headers)
+        await send_response(send, status, text, 'text/plain; charset=utf-8')
+    elif method == 'GET' and path == '/healthz':
+        await send_response(send, 200, {'status': 'ok'})
+    elif method == 'GET' and path == '/ready':
+        payload, status = main.readiness_status()
+        await send_response(send, status, payload)
+    elif method == 'GET' and path == '/metrics':
+        payload, status = main.metrics_status()
+        payload['webhook_pending_events'] = async_dispatcher.pending()
+        await send_response(send, status, payload)
+    elif method == 'POST' and path == '/catalog/refresh':
+        loop = asyncio.get_running_loop()
+        payload, status = await loop.run_in_executor(
+            inference_executor, main.refresh_catalog_status, headers.get('x-refresh-token', ''))
+        await send_response(send, status, payload)
+    else:
+        await send_response(send, 404, {'status': 'not found'})
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, port=5000)
@@ -0,0 +1,58 @@
+import argparse
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from linebot.models import TextSendMessage
+
+import main
+
+parser = argparse.ArgumentParser(description="Measure reply latency against a local stub of the LINE reply endpoint: "
+                                             "a new LineBotApi per message (old behaviour) vs the shared pooled client")
+parser.add_argument('--messages', type=int, default=500, help="replies sent per mode")
+parser.add_argument('--server-delay-ms', type=float, default=0.0, help="time the stub spends on each reply")
+args = parser.parse_args()
+
+class StubReplyHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive, like api.line.me
+    disable_nagle_algorithm = True  # headers and body go out as separate writes
+    connections = set()
+
+    def do_POST(self):
+        StubReplyHandler.connections.add(self.client_address)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if args.server_delay_ms:
+            time.sleep(args.server_delay_ms / 1000)
+        body = b'{}'
+        self.send_response(200 if self.path == '/v2/bot/message/reply' else 404)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *log_args):
+        pass
+
+server = ThreadingHTTPServer(('127.0.0.1', 0), StubReplyHandler)
+threading.Thread(target=server.serve_forever, daemon=True).start()
+endpoint = f"http://127.0.0.1:{server.server_address[1]}"
+message = TextSendMessage(text='สวัสดีค่ะ! ยินดีให้คำแนะนำเรื่องน้ำหอม (perfume) ค่ะ 🌸')
+
+def run(label, get_client):
+    StubReplyHandler.connections = set()
+    timings = []
+    for i in range(args.messages):
+        started = time.perf_counter()
+        get_client().reply_message(f"token-{i}", message)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    print(f"{label:<22} mean {statistics.mean(timings):6.2f} ms  p50 {timings[len(timings) // 2]:6.2f} ms  "
+          f"p95 {timings[int(len(timings) * 0.95)]:6.2f} ms  connections {len(StubReplyHandler.connections)}")
+    return statistics.mean(timings)
+
+per_message = run('new client per message', lambda: main.create_line_bot_api('stub-token', endpoint, pooled=False))
+shared_client = main.create_line_bot_api('stub-token', endpoint)
+pooled = run('shared pooled client', lambda: shared_client)
+print(f"Saved per message: {per_message - pooled:.2f} ms (plain HTTP; TLS to api.line.me adds a handshake per new connection)")
+server.shutdown()
@@ -0,0 +1,29 @@
+import argparse
+
+import main
+
+parser = argparse.ArgumentParser(description="Encode every product and save the FAISS product index, "
+                                             "the precomputed similar-product lists and the intent/FAQ index")
+parser.add_argument('--output', default=main.PRODUCT_INDEX_PATH, help="path of the .faiss file to write")
+parser.add_argument('--index-type', default=main.PRODUCT_INDEX_TYPE, choices=['auto', 'flat', 'ivf', 'hnsw'])
+parser.add_argument('--similar-output', default=main.SIMILAR_PRODUCTS_PATH,
+                    help="path of the similar-products JSON to write")
+parser.add_argument('--similar-k', type=int, default=main.SIMILAR_PRODUCTS_K, help="neighbours kept per product")
+parser.add_argument('--faq-output', default=main.INTENT_FAQ_INDEX_PATH, help="path of the intent/FAQ .faiss file to write")
+args = parser.parse_args()
+
+snapshot = main.product_catalog.snapshot
+products = snapshot.products
+index = main.ProductVectorIndex.build(products, index_type=args.index_type)
+index.save(args.output)
+print(f"Product index saved: {len(index.keys)} products -> {args.output}")
+
+# Embeddings are already in the embedding cache from the index build above
+similar = main.SimilarProducts.build(products, k=args.similar_k, version=snapshot.version)
+similar.save(args.similar_output)
+print(f"Similar products saved: {len(similar.neighbors)} products -> {args.similar_output}")
+
+entries = main.faq_entries()
+faq_index = main.IntentFaqIndex.build(entries)
+faq_index.save(args.faq_output)
+print(f"Intent/FAQ index saved: {len(entries)} rows -> {args.faq_output}")
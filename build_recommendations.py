@@ -0,0 +1,16 @@
+import argparse
+import time
+
+import main
+
+parser = argparse.ArgumentParser(description="Build per-user product recommendations from ADDED_TO_CART edges")
+parser.add_argument('--output', default=main.USER_RECOMMENDATIONS_PATH, help="path of the JSON file to write")
+parser.add_argument('--top-n', type=int, default=main.USER_RECOMMENDATIONS_N, help="products kept per user")
+args = parser.parse_args()
+
+started = time.time()
+edges = main.graph.read(main.CART_EDGES_QUERY)
+recommendations = main.UserRecommendations.build(edges, n=args.top_n, version=int(time.time()))
+recommendations.save(args.output)
+print(f"Recommendations saved: {len(recommendations.recommendations)} users from {len(edges)} cart edges "
+      f"in {time.time() - started:.2f}s -> {args.output}")
@@ -0,0 +1,46 @@
+import argparse
+import random
+import time
+
+import main
+
+parser = argparse.ArgumentParser(description="Check that the key-skipping normalizer gives exactly the result of "
+                                             "the ordered mapping passes, on fuzzed text, and time both")
+parser.add_argument('--cases', type=int, default=200000, help="random texts to compare")
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+normalizer = main.text_normalizer
+rng = random.Random(args.seed)
+# Whole keys, their prefixes / suffixes and replacements, so overlaps and chains get exercised
+pieces = []
+for key, _, replacement in normalizer.mapping_passes:
+    pieces += [key, key.upper(), key[:len(key) // 2], key[len(key) // 2:], replacement]
+pieces += ['ๆ', 'ะ', ' ', 'a', 'ดี', 'ไหน', 'K', 'ſ']
+pieces += [text for text, _ in main.intent_data]
+
+mismatches = 0
+for _ in range(args.cases):
+    text = ''.join(rng.choice(pieces) for _ in range(rng.randint(1, 8)))
+    expected = normalizer._apply_mappings_in_order(text)
+    actual = normalizer._apply_mappings(text)
+    if actual != expected:
+        mismatches += 1
+        if mismatches <= 10:
+            print(f"MISMATCH {text!r}: {actual!r} != {expected!r}")
+print(f"{args.cases} texts, {mismatches} mismatches")
+
+messages = ['สวัสดีค่ะ', 'แนะนำ perfume กลิ่นสดชื่นสำหรับหน้าร้อนหน่อยค่ะ',
+            'อยากได้น้ำหอมไปเดทกลางคืน มีอะไรน่าสนใจบ้างคะ งบไม่เกิน 3000 บาท ขอแบบ sweet ๆ หน่อยนะ',
+            'Looking for a fresh citrus cologne for the office, something light for summer mornings ' * 3]
+for message in messages:
+    timings = {}
+    for label, apply in (('ordered passes', normalizer._apply_mappings_in_order),
+                         ('skip absent keys', normalizer._apply_mappings)):
+        started = time.perf_counter()
+        for _ in range(2000):
+            apply(message)
+        timings[label] = (time.perf_counter() - started) / 2000 * 1e6
+    print(f"{len(message):4d} chars: " + '  '.join(f"{label} {us:7.1f} us" for label, us in timings.items()))
+if mismatches:
+    raise SystemExit(1)
@@ -1,50 +1,240 @@
-from py2neo import Graph, Node, Relationship
+from py2neo import Graph
+import argparse
+import hashlib
 import json
+import os
+import re
+import time
+import urllib.request
 
-# เชื่อมต่อกับ Neo4j
-graph = Graph("neo4j://localhost:7687", auth=("neo4j", "theoneandonlyhana"))
-
-# โหลดข้อมูล JSON
-with open('C:\\Users\\firhana\\socialai\\jomalone\\product_json\\jomalone_products.json', encoding='utf-8') as f:
-    data = json.load(f)
-
-# ฟังก์ชันเพื่อสร้างโหนดและความสัมพันธ์
-def create_product_node(product):
-    # สร้างโหนด Product
-    product_node = Node("Product",
-                        title=product['title'],
-                        size=product['size'],
-                        price=product['price'],
-                        image_url=product['image_url'],
-                        review=product['review'],
-                        stock=product['Stock'])
-    graph.create(product_node)
-
-    # สร้างหรือเชื่อมโยงโหนด Status
-    status_node = graph.nodes.match("Status", name=product['status']).first()
-    if status_node is None:
-        status_node = Node("Status", name=product['status'])
-        graph.create(status_node)
-    
-    # สร้างความสัมพันธ์ระหว่าง Product และ Status
-    graph.create(Relationship(product_node, "HAS_STATUS", status_node))
-
-    # สร้างโหนด Note (Top, Heart, Base) และสร้างความสัมพันธ์
-    top_note = Node("Note", type="Top Note", description=product['top_note'])
-    heart_note = Node("Note", type="Heart Note", description=product['Heart_Note'])
-    base_note = Node("Note", type="Base Note", description=product['Base Note'])
-
-    graph.create(top_note)
-    graph.create(heart_note)
-    graph.create(base_note)
-
-    # เชื่อมโยง Notes กับ Product
-    graph.create(Relationship(product_node, "HAS_TOP_NOTE", top_note))
-    graph.create(Relationship(product_node, "HAS_HEART_NOTE", heart_note))
-    graph.create(Relationship(product_node, "HAS_BASE_NOTE", base_note))
-
-# ลูปผ่านข้อมูล JSON ทั้งหมดแล้วสร้างโหนดและความสัมพันธ์
-for product in data:
-    create_product_node(product)
-
-print("Data imported successfully into Neo4j!")
+# เปลี่ยนเมื่อรูปแบบกราฟเปลี่ยน เพื่อให้ sync เขียนสินค้าทุกตัวใหม่หนึ่งครั้ง
+GRAPH_SCHEMA_VERSION = 3
+
+# ชั้นของโน้ตใน JSON -> ชนิดความสัมพันธ์ Product -> Ingredient
+NOTE_LAYERS = [('top', 'top_note'), ('heart', 'Heart_Note'), ('base', 'Base Note')]
+
+# ชื่อโหนด Catalog ที่เก็บ version ของข้อมูลสินค้า (main.py ใช้ตรวจว่าต้องโหลด catalog ใหม่ไหม)
+CATALOG_NAME = 'products'
+
+# สร้าง constraint / index ที่การ import ใช้ก่อนเริ่มเขียนข้อมูล
+SCHEMA_QUERIES = [
+    "CREATE CONSTRAINT product_key IF NOT EXISTS FOR (p:Product) REQUIRE p.product_key IS UNIQUE",
+    "CREATE CONSTRAINT status_name IF NOT EXISTS FOR (s:Status) REQUIRE s.name IS UNIQUE",
+    "CREATE CONSTRAINT ingredient_name IF NOT EXISTS FOR (i:Ingredient) REQUIRE i.name_key IS UNIQUE",
+    "CREATE CONSTRAINT catalog_name IF NOT EXISTS FOR (c:Catalog) REQUIRE c.name IS UNIQUE",
+    "CREATE INDEX product_title IF NOT EXISTS FOR (p:Product) ON (p.title)",
+    # Range indexes for the price / size / rating filters in main.py
+    "CREATE INDEX product_price_thb IF NOT EXISTS FOR (p:Product) ON (p.price_thb)",
+    "CREATE INDEX product_size_ml IF NOT EXISTS FOR (p:Product) ON (p.size_ml)",
+    "CREATE INDEX product_rating IF NOT EXISTS FOR (p:Product) ON (p.rating)",
+]
+
+# โหนดจาก import แบบเก่า (ยังไม่มี product_key): รับมาใช้ต่อหนึ่งโหนดต่อ image_url เพื่อไม่ให้ตะกร้าหาย
+ADOPT_LEGACY_QUERY = """
+MATCH (p:Product) WHERE p.product_key IS NULL AND p.image_url IS NOT NULL
+WITH p.image_url AS key, collect(p) AS nodes
+WHERE NOT EXISTS { MATCH (:Product {product_key: key}) }
+WITH key, head(nodes) AS keep
+SET keep.product_key = key
+"""
+
+# Nodes keyed by image_url before product_key became the SKU: re-key in place so carts keep their edges
+REKEY_QUERY = """
+UNWIND $rows AS row
+MATCH (p:Product {product_key: row.image_url})
+WHERE row.image_url <> row.product_key AND NOT EXISTS { MATCH (:Product {product_key: row.product_key}) }
+SET p.product_key = row.product_key
+"""
+
+EXISTING_QUERY = """
+MATCH (p:Product) WHERE p.product_key IS NOT NULL
+RETURN p.product_key AS product_key, p.content_hash AS content_hash
+"""
+
+# สร้างหรืออัปเดต Product ที่เปลี่ยน พร้อม Status และโน้ต Top/Heart/Base ที่ชี้ไปยัง Ingredient ที่ใช้ร่วมกัน
+UPSERT_QUERY = """
+UNWIND $rows AS row
+MERGE (p:Product {product_key: row.product_key})
+SET p.title = row.title, p.size = row.size, p.price = row.price,
+    p.image_url = row.image_url, p.review = row.review, p.stock = row.stock,
+    p.price_thb = row.price_thb, p.size_ml = row.size_ml, p.rating = row.rating,
+    p.content_hash = row.content_hash
+WITH p, row
+OPTIONAL MATCH (p)-[old_status:HAS_STATUS]->(:Status)
+DELETE old_status
+WITH DISTINCT p, row
+OPTIONAL MATCH (p)-[old_note:TOP_NOTE|HEART_NOTE|BASE_NOTE]->(:Ingredient)
+DELETE old_note
+WITH DISTINCT p, row
+OPTIONAL MATCH (p)-[:HAS_TOP_NOTE|HAS_HEART_NOTE|HAS_BASE_NOTE]->(legacy_note:Note)
+DETACH DELETE legacy_note
+WITH DISTINCT p, row
+MERGE (s:Status {name: row.status})
+CREATE (p)-[:HAS_STATUS]->(s)
+WITH p, row
+UNWIND row.notes AS note
+MERGE (i:Ingredient {name_key: note.name_key})
+ON CREATE SET i.name = note.name
+FOREACH (_ IN CASE WHEN note.layer = 'top' THEN [1] ELSE [] END |
+    CREATE (p)-[:TOP_NOTE {description: note.description}]->(i))
+FOREACH (_ IN CASE WHEN note.layer = 'heart' THEN [1] ELSE [] END |
+    CREATE (p)-[:HEART_NOTE {description: note.description}]->(i))
+FOREACH (_ IN CASE WHEN note.layer = 'base' THEN [1] ELSE [] END |
+    CREATE (p)-[:BASE_NOTE {description: note.description}]->(i))
+"""
+
+# ลบสินค้าที่ไม่มีใน JSON แล้ว และโหนดซ้ำที่เหลือจาก import แบบเก่า
+DELETE_QUERY = """
+MATCH (p:Product) WHERE p.product_key IS NULL OR p.product_key IN $keys
+OPTIONAL MATCH (p)-[:HAS_TOP_NOTE|HAS_HEART_NOTE|HAS_BASE_NOTE]->(n:Note)
+DETACH DELETE p, n
+"""
+
+# Ingredient ที่ไม่มีสินค้าใช้แล้ว
+PRUNE_INGREDIENTS_QUERY = """
+MATCH (i:Ingredient) WHERE NOT (i)<-[:TOP_NOTE|HEART_NOTE|BASE_NOTE]-(:Product)
+DELETE i
+"""
+
+CATALOG_VERSION_QUERY = """
+MERGE (c:Catalog {name: $name})
+SET c.version = $version, c.products = $products, c.synced_at = datetime()
+"""
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Sync the product JSON into Neo4j, writing only changed products")
+    parser.add_argument('json_path', nargs='?', default=os.path.join('product_json', 'jomalone_products.json'),
+                        help="product JSON file to import")
+    parser.add_argument('--uri', default=os.environ.get('NEO4J_URI', 'neo4j://localhost:7687'))
+    parser.add_argument('--user', default=os.environ.get('NEO4J_USER', 'neo4j'))
+    parser.add_argument('--password', default=os.environ.get('NEO4J_PASSWORD', 'theoneandonlyhana'))
+    parser.add_argument('--batch-size', type=int, default=500, help="products written per transaction")
+    parser.add_argument('--full', action='store_true', help="rewrite every product even if unchanged")
+    parser.add_argument('--notify-url', default=os.environ.get('CATALOG_NOTIFY_URL'),
+                        help="chatbot /catalog/refresh URL to call after a sync that changed something")
+    return parser.parse_args()
+
+# แปลง product จาก JSON เป็น row สำหรับ UNWIND
+def to_row(product):
+    row = {
+        'product_key': product_sku(product['image_url']),  # title ซ้ำกันได้ในแต่ละขนาด แต่ SKU ไม่ซ้ำ
+        'title': product['title'],
+        'size': product['size'],
+        'price': product['price'],
+        'image_url': product['image_url'],
+        'review': product['review'],
+        'stock': product['Stock'],
+        'status': product['status'],
+        'price_thb': parse_price(product['price']),
+        'size_ml': parse_size(product['size']),
+        'rating': parse_rating(product['review']),
+        'notes': [note for layer, field in NOTE_LAYERS for note in parse_note(layer, product[field])],
+    }
+    row['content_hash'] = content_hash(row)
+    return row
+
+# SKU จาก URL รูป เช่น '.../jo_sku_L00401_1000x1000_0.png' -> 'L00401' (ไม่มี SKU ใช้ URL ทั้งหมด)
+def product_sku(image_url):
+    match = re.search(r'jo_sku_([A-Za-z0-9]+)', image_url or '')
+    return match.group(1) if match else image_url
+
+# แยกชื่อส่วนผสมจากคำอธิบายโน้ต เช่น 'แมนดาริน : สดใสและเปรี้ยว...' -> 'แมนดาริน'
+def parse_note(layer, description):
+    if not description or ':' not in description:
+        return []
+    name = ' '.join(description.split(':', 1)[0].split())
+    if not name:
+        return []
+    return [{'layer': layer, 'name': name, 'name_key': name.casefold(), 'description': description}]
+
+# '6,300 บาท' -> 6300
+def parse_price(price):
+    match = re.search(r'\d[\d,]*', price or '')
+    return int(match.group().replace(',', '')) if match else None
+
+# '100 ML' -> 100.0; ชุดหลายขวด ('3x10 ML', '9ml,30ml', 'various') ไม่มีขนาดเดียว -> None
+def parse_size(size):
+    match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*ml\s*', size or '', re.IGNORECASE)
+    return float(match.group(1)) if match else None
+
+# '4.7/5' -> 4.7; 'No Review' -> None
+def parse_rating(review):
+    match = re.fullmatch(r'\s*(\d(?:\.\d+)?)\s*/\s*5\s*', review or '')
+    return float(match.group(1)) if match else None
+
+def content_hash(row):
+    content = json.dumps([GRAPH_SCHEMA_VERSION, row], ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def catalog_version(rows):
+    hashes = ''.join(sorted(row['content_hash'] for row in rows))
+    return hashlib.sha256(hashes.encode('utf-8')).hexdigest()
+
+def create_schema(graph):
+    for query in SCHEMA_QUERIES:
+        graph.run(query)
+
+# เขียนทีละ batch, หนึ่ง transaction ต่อ batch
+def run_batched(graph, query, rows, batch_size, label):
+    started = time.time()
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        batch_started = time.time()
+        tx = graph.begin()
+        tx.run(query, rows=batch)
+        graph.commit(tx)
+        elapsed = time.time() - batch_started
+        print(f"{label} batch {start // batch_size + 1}: {len(batch)} products in {elapsed:.2f}s "
+              f"({len(batch) / max(elapsed, 1e-6):.0f} rows/sec)")
+    return time.time() - started
+
+def sync_products(graph, rows, batch_size, full=False):
+    """Upsert new/changed products and delete removed ones; returns (changed, removed)"""
+    graph.run(ADOPT_LEGACY_QUERY)
+    graph.run(REKEY_QUERY, rows=[{'image_url': row['image_url'], 'product_key': row['product_key']} for row in rows])
+    existing = {record['product_key']: record['content_hash'] for record in graph.run(EXISTING_QUERY).data()}
+
+    changed = [row for row in rows if full or existing.get(row['product_key']) != row['content_hash']]
+    keys = {row['product_key'] for row in rows}
+    removed = [key for key in existing if key not in keys]
+    print(f"{len(rows)} products in JSON: {len(changed)} new or changed, {len(removed)} removed, "
+          f"{len(rows) - len(changed)} unchanged")
+
+    if changed:
+        elapsed = run_batched(graph, UPSERT_QUERY, changed, batch_size, 'Upsert')
+        print(f"Upserted {len(changed)} products in {elapsed:.2f}s ({len(changed) / max(elapsed, 1e-6):.0f} rows/sec)")
+    # Also clears duplicates left by the old create-only import
+    tx = graph.begin()
+    tx.run(DELETE_QUERY, keys=removed)
+    tx.run(PRUNE_INGREDIENTS_QUERY)
+    graph.commit(tx)
+
+    graph.run(CATALOG_VERSION_QUERY, name=CATALOG_NAME, version=catalog_version(rows), products=len(rows))
+    return changed, removed
+
+# แจ้ง chatbot ให้โหลด catalog ใหม่ทันที
+def notify_chatbot(url):
+    headers = {'X-Refresh-Token': os.environ.get('CATALOG_REFRESH_TOKEN', '')}
+    try:
+        with urllib.request.urlopen(urllib.request.Request(url, data=b'', headers=headers), timeout=30) as response:
+            print(f"Chatbot catalog refresh: {response.status}")
+    except Exception as e:
+        print(f"Could not notify chatbot at {url}: {e}")
+
+if __name__ == '__main__':
+    args = parse_args()
+
+    # เชื่อมต่อกับ Neo4j
+    graph = Graph(args.uri, auth=(args.user, args.password))
+
+    # โหลดข้อมูล JSON (สินค้าที่ซ้ำกันใน JSON ใช้แถวสุดท้าย)
+    with open(args.json_path, encoding='utf-8') as f:
+        data = json.load(f)
+    rows = list({row['product_key']: row for row in map(to_row, data)}.values())
+
+    create_schema(graph)
+    changed, removed = sync_products(graph, rows, args.batch_size, full=args.full)
+
+    if args.notify_url and (changed or removed):
+        notify_chatbot(args.notify_url)
+    print("Data imported successfully into Neo4j!")
@@ -1,30 +1,196 @@
 from flask import Flask, request, jsonify
 from linebot import LineBotApi, WebhookHandler
 from linebot.exceptions import InvalidSignatureError
+from linebot.http_client import RequestsHttpClient, RequestsHttpResponse
 from linebot.models import (
     MessageEvent, TextMessage, TextSendMessage, FlexSendMessage, 
     QuickReply, QuickReplyButton, MessageAction, PostbackEvent, PostbackAction
 )
-from py2neo import Graph
-from sentence_transformers import SentenceTransformer
-import pandas as pd
-import faiss
+from neo4j import GraphDatabase, READ_ACCESS, WRITE_ACCESS
+import requests
+from requests.adapters import HTTPAdapter
 import numpy as np
 import json
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.naive_bayes import MultinomialNB
-from sklearn.pipeline import Pipeline
-from sklearn.model_selection import train_test_split
-import pickle
+import hashlib
+import hmac
+import contextlib
+import fcntl
 import os
+import queue
+import atexit
+import signal
+import sys
 import re
+import functools
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+from collections import OrderedDict, deque, namedtuple
 from difflib import get_close_matches
 import unicodedata
+import urllib.parse
 
-# Neo4j connection
-graph = Graph("neo4j://localhost:7687", auth=("neo4j", "theoneandonlyhana"))
+# Heavy resources (DB connection, models, indexes) load lazily so the app can bind its port right away
+class LazyResource:
+    """Builds a resource once, in the background or on first use, and proxies attribute access to it"""
+    def __init__(self, name, factory):
+        self.resource_name = name
+        self._factory = factory
+        self._value = None
+        self._error = None
+        self._loaded = threading.Event()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self._loaded.is_set()
+
+    def status(self):
+        if self.ready:
+            return 'ready'
+        if self._error is not None:
+            return f"error: {self._error}"
+        return 'loading'
+
+    def _load(self):
+        # Only one thread runs the factory; the others wait here for its result
+        with self._lock:
+            if self.ready:
+                return
+            started = time.time()
+            try:
+                self._value = self._factory()
+            except Exception as e:
+                self._error = e
+                raise
+            self._error = None
+            self._loaded.set()
+            print(f"{self.resource_name} ready in {time.time() - started:.1f}s")
+
+    def get(self):
+        if not self.ready:
+            self._load()
+        return self._value
+
+    def preload(self):
+        """Load now; False (with the error kept for status()) if the factory failed"""
+        try:
+            self._load()
+            return True
+        except Exception as e:
+            print(f"Failed to load {self.resource_name}: {e}")
+            return False
+
+    def __getattr__(self, attr):
+        return getattr(self.get(), attr)
+
+# Neo4j connection: one driver (and connection pool) per process
+# neo4j:// uses cluster routing, so read transactions can be served by followers; bolt:// talks to one server
+NEO4J_URI = os.environ.get('NEO4J_URI', 'neo4j://localhost:7687')
+NEO4J_USER = os.environ.get('NEO4J_USER', 'neo4j')
+NEO4J_PASSWORD = os.environ.get('NEO4J_PASSWORD', 'theoneandonlyhana')
+NEO4J_DATABASE = os.environ.get('NEO4J_DATABASE') or None
+NEO4J_POOL_SIZE = int(os.environ.get('NEO4J_POOL_SIZE', '50'))
+NEO4J_ACQUIRE_TIMEOUT = float(os.environ.get('NEO4J_ACQUIRE_TIMEOUT', '10'))
+NEO4J_MAX_CONNECTION_LIFETIME = float(os.environ.get('NEO4J_MAX_CONNECTION_LIFETIME', '3600'))
+NEO4J_RETRY_SECONDS = float(os.environ.get('NEO4J_RETRY_SECONDS', '15'))  # budget for retrying transient errors
+
+class GraphStore:
+    """Data access over one neo4j driver: managed read / write transactions, retried on transient errors"""
+    def __init__(self, uri=NEO4J_URI, auth=(NEO4J_USER, NEO4J_PASSWORD), database=NEO4J_DATABASE):
+        self.driver = GraphDatabase.driver(
+            uri, auth=auth,
+            max_connection_pool_size=NEO4J_POOL_SIZE,
+            connection_acquisition_timeout=NEO4J_ACQUIRE_TIMEOUT,
+            max_connection_lifetime=NEO4J_MAX_CONNECTION_LIFETIME,
+            max_transaction_retry_time=NEO4J_RETRY_SECONDS,
+            keep_alive=True)
+        self.driver.verify_connectivity()
+        self.database = database
+        # Shared by writes and read_own_writes so a read on a follower waits for this process's writes
+        self.bookmarks = GraphDatabase.bookmark_manager()
+
+    @staticmethod
+    def _fetch(tx, query, params):
+        return tx.run(query, params).data()
+
+    def read(self, query, **params):
+        with self.driver.session(database=self.database, default_access_mode=READ_ACCESS) as session:
+            return session.execute_read(self._fetch, query, params)
+
+    def read_own_writes(self, query, **params):
+        """Read that sees every earlier write from this process (e.g. the cart right after add_cart)"""
+        with self.driver.session(database=self.database, default_access_mode=READ_ACCESS,
+                                 bookmark_manager=self.bookmarks) as session:
+            return session.execute_read(self._fetch, query, params)
+
+    def write(self, query, **params):
+        with self.driver.session(database=self.database, default_access_mode=WRITE_ACCESS,
+                                 bookmark_manager=self.bookmarks) as session:
+            return session.execute_write(self._fetch, query, params)
+
+    def close(self):
+        self.driver.close()
+
+graph = LazyResource('neo4j', GraphStore)
+
+@atexit.register
+def close_graph():
+    # Registered before the chat history writer, so it runs after that has drained
+    if graph.ready:
+        graph.close()
+
+# Multi-keyword matching
+class KeywordAutomaton:
+    """Aho-Corasick automaton: finds every keyword occurring in a text in a single pass"""
+    def __init__(self, keywords):
+        self.keywords = list(keywords)
+        self.goto = [{}]
+        self.fail = [0]
+        self.output = [[]]
+
+        # Trie of all keywords
+        for keyword_id, keyword in enumerate(self.keywords):
+            state = 0
+            for char in keyword:
+                next_state = self.goto[state].get(char)
+                if next_state is None:
+                    next_state = len(self.goto)
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.output.append([])
+                    self.goto[state][char] = next_state
+                state = next_state
+            self.output[state].append(keyword_id)
+
+        # Failure links, breadth first so shorter suffixes are resolved before longer ones
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(char, 0)
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    def find(self, text):
+        """Ids of the keywords that occur in text"""
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            found.update(self.output[state])
+        return found
 
 # Text Normalization and Spell Correction
+NORMALIZER_CACHE_SIZE = 4096
+NORMALIZER_VERSION = 1  # bump when normalize_text changes behaviour
+IGNORECASE_ONLY_CHARS = frozenset('\u0130\u0131\u017f\u212a')  # İ ı ſ K
+
 class ThaiEngTextNormalizer:
     def __init__(self):
         # Common Thai-English mixed words mapping
@@ -108,56 +274,100 @@ class ThaiEngTextNormalizer:
             'occasion_date': ['เดท', 'date', 'โรแมนติก', 'romantic', 'รัก', 'love'],
             'occasion_party': ['ปาร์ตี้', 'party', 'งานเลี้ยง', 'celebration', 'กลางคืน', 'night']
         }
-    
-    def normalize_text(self, text):
-        """Normalize Thai-English mixed text"""
+
+        # One automaton over the keywords of every intent
+        self.keyword_intents = {}
+        for intent, keywords in self.intent_keywords.items():
+            for keyword in keywords:
+                self.keyword_intents.setdefault(keyword, []).append(intent)
+        self.keyword_automaton = KeywordAutomaton(self.keyword_intents)
+
+        # Common Thai particles that don't affect meaning
+        self.particles_to_remove = ['ครับ', 'ค่ะ', 'คะ', 'นะ', 'หน่อย', 'บ้าง', 'เอ่อ', 'อืม']
+
+        # The ordered passes of _apply_mappings_in_order, with the IGNORECASE patterns precompiled;
+        # _apply_mappings only runs the passes whose key occurs in the text
+        self.mapping_passes = (
+            [(eng_word.lower(), re.compile(re.escape(eng_word), re.IGNORECASE), thai_word)
+             for eng_word, thai_word in self.mixed_word_mapping.items()]
+            + [(wrong, None, correct) for wrong, correct in self.thai_spell_mapping.items()]
+            + [(particle, None, '') for particle in self.particles_to_remove])
+        self._normalize_cached = functools.lru_cache(maxsize=NORMALIZER_CACHE_SIZE)(self._normalize)
+
+    def config_fingerprint(self):
+        """Hash of the normalizer setup; an intent model is only valid with the normalizer it was trained on"""
+        config = json.dumps([NORMALIZER_VERSION, self.mixed_word_mapping, self.thai_spell_mapping,
+                             self.particles_to_remove], ensure_ascii=False)
+        return hashlib.sha256(config.encode('utf-8')).hexdigest()
+
+    def _apply_mappings_in_order(self, text):
+        """Reference behaviour: each mapping applied as its own pass, in dictionary order"""
+        for eng_word, thai_word in self.mixed_word_mapping.items():
+            text = re.sub(re.escape(eng_word), thai_word, text, flags=re.IGNORECASE)
+        for wrong, correct in self.thai_spell_mapping.items():
+            text = text.replace(wrong, correct)
+        for particle in self.particles_to_remove:
+            text = text.replace(particle, '')
+        return text
+
+    def _apply_mappings(self, text):
+        """Same result as _apply_mappings_in_order, skipping the passes that cannot change text"""
+        # re.IGNORECASE lets these match ASCII letters that str.lower() does not produce
+        if not IGNORECASE_ONLY_CHARS.isdisjoint(text):
+            return self._apply_mappings_in_order(text)
+        # A substring test per key is a C-level scan, far cheaper than a regex pass; it may
+        # over-report (spell keys are case-sensitive), never miss
+        lowered = text.lower()
+        for key, pattern, replacement in self.mapping_passes:
+            if key not in lowered:
+                continue
+            if pattern is not None:
+                replaced = pattern.sub(lambda match: replacement, text)
+            else:
+                replaced = text.replace(key, replacement)
+            if replaced != text:
+                # A replacement can create or destroy later keys, so later tests use the new text
+                text = replaced
+                lowered = text.lower()
+        return text
+
+    def _normalize(self, text):
         # Convert to lowercase for English parts
         normalized = text.lower()
-        
+
         # Remove extra spaces and normalize Unicode
-        normalized = re.sub(r'\s+', ' ', normalized.strip())
+        normalized = ' '.join(normalized.split())
         normalized = unicodedata.normalize('NFKC', normalized)
-        
-        # Replace common mixed words
-        for eng_word, thai_word in self.mixed_word_mapping.items():
-            # Case insensitive replacement
-            pattern = re.compile(re.escape(eng_word), re.IGNORECASE)
-            normalized = pattern.sub(thai_word, normalized)
-        
-        # Apply Thai spelling corrections
-        for wrong, correct in self.thai_spell_mapping.items():
-            normalized = normalized.replace(wrong, correct)
-        
-        # Remove common Thai particles that don't affect meaning
-        particles_to_remove = ['ครับ', 'ค่ะ', 'คะ', 'นะ', 'หน่อย', 'บ้าง', 'เอ่อ', 'อืม']
-        for particle in particles_to_remove:
-            normalized = normalized.replace(particle, '')
-        
+
+        # Mixed words, Thai spelling corrections and particles
+        normalized = self._apply_mappings(normalized)
+
         # Clean up extra spaces again
-        normalized = re.sub(r'\s+', ' ', normalized.strip())
-        
-        return normalized
+        return ' '.join(normalized.split())
+
+    def normalize_text(self, text):
+        """Normalize Thai-English mixed text"""
+        return self._normalize_cached(text)
     
-    def extract_intent_from_text(self, text):
-        """Extract intent from normalized text using keyword matching"""
-        normalized_text = self.normalize_text(text)
-        
-        # Score each intent based on keyword presence
-        intent_scores = {}
-        for intent, keywords in self.intent_keywords.items():
-            score = 0
-            for keyword in keywords:
-                if keyword in normalized_text:
-                    score += 1
-            if score > 0:
-                intent_scores[intent] = score
-        
-        # Return the intent with highest score
+    def score_intents(self, normalized_text):
+        """Number of keywords of each intent found in already-normalized text, in intent order"""
+        hits = {}
+        for keyword_id in self.keyword_automaton.find(normalized_text):
+            for intent in self.keyword_intents[self.keyword_automaton.keywords[keyword_id]]:
+                hits[intent] = hits.get(intent, 0) + 1
+        return {intent: hits[intent] for intent in self.intent_keywords if intent in hits}
+
+    @staticmethod
+    def best_intent(intent_scores):
+        """The intent with highest score, or (None, 0) when nothing matched"""
         if intent_scores:
             return max(intent_scores.items(), key=lambda x: x[1])
-        
         return None, 0
 
+    def extract_intent_from_text(self, text):
+        """Extract intent from normalized text using keyword matching"""
+        return self.best_intent(self.score_intents(self.normalize_text(text)))
+
 # Enhanced Intent Classification Data with Thai-English mixed examples
 intent_data = [
     # Basic greetings
@@ -278,31 +488,136 @@ for text, intent in intent_data:
     normalized_text = text_normalizer.normalize_text(text)
     normalized_intent_data.append([normalized_text, intent])
 
-# Create DataFrame for intent classification
-intent_df = pd.DataFrame(normalized_intent_data, columns=['text', 'intent'])
+# sentence_transformers, faiss, sklearn, joblib and scipy take seconds to import, so they are imported
+# inside the LazyResource factories and the functions that use them, never at module level
 
 # Enhanced multilingual sentence transformer
 def get_multilingual_encoder():
     """Get best multilingual model for Thai-English mixed text"""
+    from sentence_transformers import SentenceTransformer
     try:
         # Try to use a more advanced multilingual model
-        return SentenceTransformer('sentence-transformers/paraphrase-multilingual-mpnet-base-v2')
+        model_name = 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
+        model = SentenceTransformer(model_name)
     except:
         # Fallback to the original model
-        return SentenceTransformer('sentence-transformers/distiluse-base-multilingual-cased-v2')
+        model_name = 'sentence-transformers/distiluse-base-multilingual-cased-v2'
+        model = SentenceTransformer(model_name)
+    model.model_name = model_name
+    return model
 
-encoder = get_multilingual_encoder()
+encoder = LazyResource('encoder', get_multilingual_encoder)
 
-# Train Intent Classifier with normalized data
-def train_intent_classifier():
-    model_path = 'intent_classifier_normalized.pkl'
-    
-    if os.path.exists(model_path):
-        with open(model_path, 'rb') as f:
-            return pickle.load(f)
-    
-    # Create and train the model with better parameters for mixed language
-    classifier = Pipeline([
+# On-disk embedding cache so restarts only encode new or changed texts
+EMBEDDING_CACHE_DIR = os.environ.get('EMBEDDING_CACHE_DIR', 'embedding_cache')
+
+class EmbeddingStore:
+    """Memory-mapped float32 matrix of embeddings keyed by model name + hash of the normalized text
+
+    Every gunicorn worker shares the same files, so loads and appends hold an flock on the .lock file:
+    rows are only ever appended, and keys.json is replaced atomically after the rows it lists are written.
+    """
+    def __init__(self, directory, model, model_name):
+        self.model = model
+        self.model_name = model_name
+        slug = re.sub(r'[^\w.-]+', '_', model_name)
+        os.makedirs(directory, exist_ok=True)
+        self.matrix_path = os.path.join(directory, f"{slug}.f32")
+        self.keys_path = os.path.join(directory, f"{slug}.keys.json")
+        self.lock_path = os.path.join(directory, f"{slug}.lock")
+        self.dimension = None
+        self.rows = {}
+        self.matrix = None
+        self._lock = threading.Lock()
+        with self._file_lock():
+            self._reload()
+
+    @contextlib.contextmanager
+    def _file_lock(self):
+        with open(self.lock_path, 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _reload(self):
+        """Pick up rows other workers appended; call with the file lock held"""
+        if not os.path.exists(self.keys_path) or not os.path.exists(self.matrix_path):
+            return
+        with open(self.keys_path, encoding='utf-8') as f:
+            meta = json.load(f)
+        self.dimension = meta['dimension']
+        self.rows = {key: row for row, key in enumerate(meta['keys'])}
+        # Drop rows written by an append that crashed before its keys were saved
+        with open(self.matrix_path, 'r+b') as f:
+            f.truncate(len(self.rows) * self.dimension * 4)
+        self._open_matrix()
+
+    @staticmethod
+    def normalize(text):
+        return ' '.join(unicodedata.normalize('NFKC', text).split())
+
+    def text_key(self, normalized_text):
+        return hashlib.sha256(f"{self.model_name}\n{normalized_text}".encode('utf-8')).hexdigest()
+
+    def _open_matrix(self):
+        if self.rows:
+            self.matrix = np.memmap(self.matrix_path, dtype='float32', mode='r',
+                                    shape=(len(self.rows), self.dimension))
+
+    def _append(self, keys, vectors):
+        """Write vectors after the rows already on disk; call with the file lock held"""
+        self.dimension = vectors.shape[1]
+        with open(self.matrix_path, 'ab') as f:
+            first_row = f.tell() // (self.dimension * 4)
+            f.write(np.ascontiguousarray(vectors, dtype='float32').tobytes())
+        for offset, key in enumerate(keys):
+            self.rows[key] = first_row + offset
+        ordered_keys = sorted(self.rows, key=self.rows.get)
+        tmp_path = f"{self.keys_path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': self.model_name, 'dimension': self.dimension, 'keys': ordered_keys}, f)
+        os.replace(tmp_path, self.keys_path)
+        self._open_matrix()
+
+    def encode(self, texts):
+        """Embeddings for texts, running the model only on texts not stored yet"""
+        normalized = [self.normalize(text) for text in texts]
+        keys = [self.text_key(text) for text in normalized]
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                with self._file_lock():
+                    self._reload()
+                    missing = {}
+                    for key, text in zip(keys, normalized):
+                        if key not in self.rows and key not in missing:
+                            missing[key] = text
+                    if missing:
+                        print(f"Encoding {len(missing)} new texts with {self.model_name}")
+                        vectors = np.asarray(self.model.encode(list(missing.values())), dtype='float32')
+                        self._append(list(missing), vectors)
+            if not keys:
+                return np.zeros((0, self.dimension or 0), dtype='float32')
+            return np.array(self.matrix[[self.rows[key] for key in keys]])
+
+embedding_store = LazyResource(
+    'embedding store', lambda: EmbeddingStore(EMBEDDING_CACHE_DIR, encoder.get(), encoder.model_name))
+
+# Intent model artifact: trained offline by train_intent.py, loaded read-only by the workers
+INTENT_MODEL_PATH = os.environ.get('INTENT_MODEL_PATH', 'intent_classifier.joblib')
+INTENT_MODEL_FORMAT = 1  # bump when the pipeline below changes
+ALLOW_INTENT_TRAINING = os.environ.get('ALLOW_INTENT_TRAINING', '0') == '1'
+
+class IntentModelError(Exception):
+    """The intent model artifact is missing, corrupt, or was trained for other data"""
+
+def build_intent_pipeline():
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.naive_bayes import MultinomialNB
+    from sklearn.pipeline import Pipeline
+    # Create the model with better parameters for mixed language
+    return Pipeline([
         ('tfidf', TfidfVectorizer(
             ngram_range=(1, 3),  # Include trigrams for better context
             max_features=2000,   # Increase features for mixed language
@@ -312,204 +627,831 @@ def train_intent_classifier():
         )),
         ('nb', MultinomialNB(alpha=0.1))  # Lower smoothing for better precision
     ])
-    
-    X = intent_df['text']
-    y = intent_df['intent']
-    
-    classifier.fit(X, y)
-    
-    # Save the model
-    with open(model_path, 'wb') as f:
-        pickle.dump(classifier, f)
-    
+
+def intent_model_fingerprint():
+    """What an artifact must have been trained with to be usable by this code"""
+    import sklearn
+    training_data = json.dumps(intent_data, ensure_ascii=False).encode('utf-8')
+    return {
+        'format': INTENT_MODEL_FORMAT,
+        'training_data_sha256': hashlib.sha256(training_data).hexdigest(),
+        'normalizer_sha256': text_normalizer.config_fingerprint(),
+        'sklearn_version': sklearn.__version__,
+    }
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def read_intent_model_meta(path):
+    if not os.path.exists(path + '.meta.json'):
+        return None
+    with open(path + '.meta.json', encoding='utf-8') as f:
+        return json.load(f)
+
+def intent_model_file(path, meta):
+    """The model a .meta.json describes; artifacts from before versioned files sit at path itself"""
+    if 'model_file' in meta:
+        return os.path.join(os.path.dirname(path), meta['model_file'])
+    return path
+
+def write_intent_model_artifact(path=INTENT_MODEL_PATH):
+    """Train on intent_data and write the model plus its .meta.json
+
+    The model goes to a file named after its checksum and the .meta.json points at it, so the one
+    rename of the .meta.json switches model and checksum together for every loading worker.
+    """
+    import joblib
+    classifier = build_intent_pipeline()
+    classifier.fit([text for text, _ in normalized_intent_data], [intent for _, intent in normalized_intent_data])
+
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    joblib.dump(classifier, tmp_path)
+    checksum = file_sha256(tmp_path)
+    model_path = f"{path}.{checksum[:16]}"
+    os.replace(tmp_path, model_path)
+    meta = dict(intent_model_fingerprint(), sha256=checksum, model_file=os.path.basename(model_path),
+                examples=len(normalized_intent_data), trained_at=time.strftime('%Y-%m-%dT%H:%M:%S'))
+
+    previous = read_intent_model_meta(path)
+    with open(path + '.meta.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(path + '.meta.json.tmp', path + '.meta.json')
+
+    # Keep the model the old .meta.json pointed at: a worker may have read it just before the switch
+    keep = {model_path, intent_model_file(path, previous) if previous else None}
+    for name in os.listdir(os.path.dirname(path) or '.'):
+        old_path = os.path.join(os.path.dirname(path), name)
+        if re.fullmatch(re.escape(os.path.basename(path)) + r'\.[0-9a-f]{16}', name) and old_path not in keep:
+            os.remove(old_path)
     return classifier
 
+def load_intent_model_artifact(path=INTENT_MODEL_PATH):
+    """Memory-map a model artifact, refusing it unless it matches the current data and normalizer"""
+    import joblib
+    meta = read_intent_model_meta(path)
+    model_path = intent_model_file(path, meta) if meta else path
+    if meta is None or not os.path.exists(model_path):
+        raise IntentModelError(f"{path} not found, run: python train_intent.py")
+    for key, expected in intent_model_fingerprint().items():
+        if meta.get(key) != expected:
+            raise IntentModelError(f"{path} is stale ({key} changed), run: python train_intent.py")
+    if file_sha256(model_path) != meta.get('sha256'):
+        raise IntentModelError(f"{model_path} does not match its checksum")
+    return joblib.load(model_path, mmap_mode='r')
+
+def load_intent_classifier():
+    try:
+        return load_intent_model_artifact()
+    except IntentModelError as e:
+        if not ALLOW_INTENT_TRAINING:
+            raise
+        # Local development only: deploys ship a pre-trained artifact
+        print(f"{e}; training in-process because ALLOW_INTENT_TRAINING=1")
+        return write_intent_model_artifact()
+
 # Initialize intent classifier
-intent_classifier = train_intent_classifier()
+intent_classifier = LazyResource('intent classifier', load_intent_classifier)
+
+# Label, confidence and full distribution from one predict_proba call
+IntentPrediction = namedtuple('IntentPrediction', ['intent', 'confidence', 'distribution'])
+
+def predict_intents(texts):
+    """Classify many messages at once (log replay, multi-event webhooks); vectorizes once"""
+    normalized_texts = [text_normalizer.normalize_text(text) for text in texts]
+    if not normalized_texts:
+        return []
+    probabilities = intent_classifier.predict_proba(normalized_texts)
+    classes = [str(label) for label in intent_classifier.classes_]
+    predictions = []
+    for row in probabilities:
+        best = int(np.argmax(row))
+        predictions.append(IntentPrediction(classes[best], float(row[best]), dict(zip(classes, row.tolist()))))
+    return predictions
+
+def predict_intent(text):
+    return predict_intents([text])[0]
+
+# Product catalog snapshot
+# Title keywords per intent (English parts are matched against the lower-cased title)
+INTENT_TITLE_KEYWORDS = {
+    'scent_fresh': ['fresh', 'light', 'citrus', 'ocean', 'clean', 'cool', 'aqua', 'blue', 'mint', 'green',
+                    'สดชื่น', 'เซฟ', 'เบา', 'ใส', 'น้ำใส', 'ทะเล', 'เย็น', 'สด'],
+    'scent_sweet': ['sweet', 'vanilla', 'floral', 'rose', 'flower', 'pink', 'cherry', 'peach',
+                    'หวาน', 'ดอกไม้', 'กุหลาบ', 'หอม', 'วานิลลา', 'ชมพู'],
+    'scent_sexy': ['intense', 'black', 'noir', 'dark', 'deep', 'red', 'sexy', 'seductive',
+                   'เซ็กซี่', 'ดำ', 'เข้ม', 'แรง', 'ดึงดูด', 'แดง'],
+    'season_summer': ['fresh', 'light', 'citrus', 'ocean', 'cool', 'aqua', 'blue', 'summer', 'mint', 'ice',
+                      'สดชื่น', 'เซฟ', 'เบา', 'ร้อน', 'เย็น', 'สด'],
+    'season_winter': ['warm', 'intense', 'rich', 'deep', 'dark', 'winter', 'spice', 'wood',
+                      'อุ่น', 'เข้ม', 'หนาว', 'แรง', 'เครื่องเทศ', 'ไม้'],
+    'occasion_work': ['light', 'fresh', 'clean', 'subtle', 'office', 'work', 'professional', 'classic',
+                      'เบา', 'เซฟ', 'ทำงาน', 'ออฟฟิศ', 'เรียบร้อย', 'สุภาพ'],
+    'occasion_date': ['romance', 'love', 'sexy', 'seductive', 'date', 'heart', 'passion', 'charm',
+                      'โรแมนติก', 'รัก', 'เดท', 'หัวใจ', 'ดึงดูด', 'เสน่ห์'],
+    'occasion_party': ['intense', 'bold', 'strong', 'party', 'night', 'club', 'celebration', 'festive',
+                       'ปาร์ตี้', 'แรง', 'เลี้ยง', 'กลางคืน', 'สนุก', 'เฟส'],
+}
+
+# Status-based intents
+INTENT_STATUS = {
+    'product_bestseller': 'BESTSELLER',
+    'product_new': 'NEW',
+    'product_limited': 'Limited Edition',
+}
+
+CATALOG_QUERY = """
+MATCH (p:Product)
+RETURN p.product_key AS product_key, p.title AS title, p.price AS price, p.size AS size,
+       p.image_url AS image_url, p.review AS review, p.stock AS stock,
+       p.price_thb AS price_thb, p.size_ml AS size_ml, p.rating AS rating,
+       [(p)-[:HAS_STATUS]->(s:Status) | s.name] AS statuses,
+       head([(p)-[r:TOP_NOTE]->(:Ingredient) | r.description]) AS top_note,
+       head([(p)-[r:HEART_NOTE]->(:Ingredient) | r.description]) AS heart_note,
+       head([(p)-[r:BASE_NOTE]->(:Ingredient) | r.description]) AS base_note,
+       [(p)-[:TOP_NOTE|HEART_NOTE|BASE_NOTE]->(i:Ingredient) | i.name_key] AS ingredients
+"""
+
+# Written by imprt_neo4j.py after every sync
+CATALOG_VERSION_QUERY = """
+MATCH (c:Catalog {name: 'products'})
+RETURN c.version AS version
+"""
+
+CATALOG_REFRESH_SECONDS = int(os.environ.get('CATALOG_REFRESH_SECONDS', '300'))
+CATALOG_REFRESH_TOKEN = os.environ.get('CATALOG_REFRESH_TOKEN', '')  # /catalog/refresh is disabled when unset
+PRODUCT_RESULT_LIMIT = 5
+
+def review_rank(review):
+    """Same rating buckets the old product_reviewed Cypher used for ORDER BY"""
+    if re.fullmatch(r'5(\.0)?/5', review):
+        return 5.0
+    if re.fullmatch(r'4\.[5-9]/5', review):
+        return 4.7
+    if re.fullmatch(r'4\.[0-4]/5', review):
+        return 4.2
+    if re.fullmatch(r'3\.[5-9]/5', review):
+        return 3.7
+    return 0.0
+
+def has_review(review):
+    return bool(review) and 'No Review' not in review and re.search(r'[0-9]', review) is not None
+
+def product_key(product):
+    """Identity of a catalog row: the SKU from imprt_neo4j.py (titles repeat across bottle sizes)"""
+    return product.get('product_key') or product['image_url']
+
+class InvertedIndex:
+    """Character-bigram postings over one text field of the catalog"""
+    def __init__(self, texts):
+        self.texts = [(text or '').lower() for text in texts]
+        self.grams = {}
+        for doc_id, text in enumerate(self.texts):
+            # Single characters are kept too so one-letter lookups still resolve
+            grams = {text[i:i + 2] for i in range(len(text) - 1)} | set(text)
+            for gram in grams:
+                self.grams.setdefault(gram, set()).add(doc_id)
+
+    def lookup(self, keyword):
+        """Documents containing keyword as a substring (same as Cypher CONTAINS)"""
+        keyword = keyword.lower()
+        if not keyword:
+            return set()
+        if len(keyword) == 1:
+            return set(self.grams.get(keyword, ()))
+
+        # Intersect bigram posting lists, smallest first, then verify the survivors
+        postings = sorted((self.grams.get(keyword[i:i + 2], ()) for i in range(len(keyword) - 1)), key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            if not candidates:
+                break
+            candidates &= posting
+        return {doc_id for doc_id in candidates if keyword in self.texts[doc_id]}
+
+    def lookup_any(self, keywords):
+        """Union of the posting lists of all keywords"""
+        matches = set()
+        for keyword in keywords:
+            matches |= self.lookup(keyword)
+        return matches
+
+# Product-title registry: O(1) exact / case-folded / alias lookup, plus fuzzy resolution
+TITLE_ALIASES_PATH = os.environ.get('TITLE_ALIASES_PATH', os.path.join('product_json', 'title_aliases.json'))
+TITLE_MATCH_CUTOFF = float(os.environ.get('TITLE_MATCH_CUTOFF', '0.8'))  # difflib ratio for typo matches
+TITLE_RESOLVE_MIN_LENGTH = 3  # shorter text ('a', 'ok') only matches exactly, never as a substring or typo
+TITLE_COMMON_WORD_SHARE = 0.1  # words in more names than this ('cologne', 'and') never match on their own
+TITLE_TYPO_CANDIDATES = 20  # names sharing the most character bigrams that get the difflib comparison
+
+TitleMatch = namedtuple('TitleMatch', ['title', 'product_key', 'kind'])
+
+def load_title_aliases(path=TITLE_ALIASES_PATH):
+    """Canonical title -> other names customers use for it (Thai names, abbreviations)"""
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+class TitleRegistry:
+    """Maps what a user typed (or a postback carried) to one catalog title and its product_key"""
+    def __init__(self, products, aliases=None):
+        self.by_title = {}
+        for p in products:
+            self.by_title.setdefault(p['title'], product_key(p))
+
+        # Every title and alias, case-folded, pointing at its canonical title
+        self.names = []
+        self.by_name = {}
+        named = [(title, title) for title in self.by_title]
+        for title, title_aliases in (aliases or {}).items():
+            if title in self.by_title:
+                named.extend((alias, title) for alias in title_aliases)
+        for name, title in named:
+            folded = self.fold(name)
+            if folded and folded not in self.by_name:
+                self.by_name[folded] = title
+                self.names.append((folded, title))
+        self.index = InvertedIndex(folded for folded, _ in self.names)
+        word_counts = {}
+        for folded, _ in self.names:
+            for word in set(folded.split()):
+                word_counts[word] = word_counts.get(word, 0) + 1
+        self.common_words = {word for word, count in word_counts.items()
+                             if count > max(2, len(self.names) * TITLE_COMMON_WORD_SHARE)}
+
+    @staticmethod
+    def fold(text):
+        text = unicodedata.normalize('NFKC', text).casefold()
+        return ' '.join(re.sub(r'\s*&\s*', ' and ', text).split())
+
+    def __len__(self):
+        return len(self.by_title)
+
+    def is_common(self, folded):
+        """Only words shared by many names ('cologne', 'and intense'): not specific to any product"""
+        return all(word in self.common_words for word in folded.split())
+
+    def _match(self, title, kind):
+        return TitleMatch(title, self.by_title[title], kind)
+
+    def lookup(self, text):
+        """Exact title, case/spacing variant or alias; None otherwise. Two dict probes, no scanning"""
+        if text in self.by_title:
+            return self._match(text, 'exact')
+        title = self.by_name.get(self.fold(text))
+        if title is None:
+            return None
+        return self._match(title, 'alias' if self.fold(title) != self.fold(text) else 'casefold')
+
+    def resolve(self, text):
+        """lookup(), then prefix/substring, then typo-tolerant matching over titles and aliases"""
+        match = self.lookup(text)
+        if match is not None:
+            return match
+        folded = self.fold(text)
+        if len(folded) < TITLE_RESOLVE_MIN_LENGTH or self.is_common(folded):
+            return None
+
+        # Prefix beats substring; among equals the shortest (most specific) name wins
+        contained = self.index.lookup(folded)
+        if contained:
+            best = min(contained, key=lambda i: (not self.names[i][0].startswith(folded), len(self.names[i][0]), i))
+            return self._match(self.names[best][1], 'substring')
+
+        # Typos: shortlist names by shared character bigrams, then let difflib pick the closest
+        shared = {}
+        for gram in {folded[i:i + 2] for i in range(len(folded) - 1)} or {folded}:
+            for doc_id in self.index.grams.get(gram, ()):
+                shared[doc_id] = shared.get(doc_id, 0) + 1
+        shortlist = sorted(shared, key=lambda i: (-shared[i], i))[:TITLE_TYPO_CANDIDATES]
+        # Compared against word spans about as long as the query, so 'myrh and tonka' still finds
+        # 'myrrh and tonka cologne intense'
+        spans = {}
+        length = len(folded.split())
+        for doc_id in shortlist:
+            words = self.names[doc_id][0].split()
+            for size in range(max(1, length - 1), length + 2):
+                for start in range(max(1, len(words) - size + 1)):
+                    span = ' '.join(words[start:start + size])
+                    if self.is_common(span):
+                        continue
+                    # Same span in several names (e.g. '... cologne' and '... cologne miniature'): shortest wins
+                    if span not in spans or len(self.names[doc_id][0]) < len(self.names[spans[span]][0]):
+                        spans[span] = doc_id
+        close = get_close_matches(folded, list(spans), n=1, cutoff=TITLE_MATCH_CUTOFF)
+        if close:
+            return self._match(self.names[spans[close[0]]][1], 'typo')
+        return None
+
+class CatalogSnapshot:
+    """Read-only copy of the Product nodes with every intent result list precomputed"""
+    def __init__(self, products, version=None):
+        self.products = tuple(products)
+        self.version = version
+        self.loaded_at = time.time()
+        self.by_key = {product_key(p): p for p in self.products}
+        # Rebuilt with every snapshot, so titles added by a catalog sync resolve without a restart
+        self.titles = TitleRegistry(self.products, load_title_aliases())
+
+        self.intent_results = {}
+        for intent, status in INTENT_STATUS.items():
+            self.intent_results[intent] = tuple(
+                p for p in self.products if status in p['statuses'])
+        self.title_index = InvertedIndex(p['title'] for p in self.products)
+        self.note_index = InvertedIndex(
+            ' '.join(filter(None, (p['top_note'], p['heart_note'], p['base_note']))) for p in self.products)
+        for intent, keywords in INTENT_TITLE_KEYWORDS.items():
+            # Title hits first, then products that only match through their notes
+            title_hits = self.title_index.lookup_any(keywords)
+            note_hits = self.note_index.lookup_any(keywords) - title_hits
+            self.intent_results[intent] = tuple(
+                self.products[i] for i in sorted(title_hits) + sorted(note_hits))
+
+        reviewed = [p for p in self.products if has_review(p['review'])]
+        # rating มาจาก imprt_neo4j.py; review_rank ใช้กับโหนดที่ยังไม่ได้ sync ใหม่
+        reviewed.sort(key=lambda p: p.get('rating') or review_rank(p['review']), reverse=True)
+        self.intent_results['product_reviewed'] = tuple(reviewed)
+
+        # ถ้าไม่มีผลลัพธ์ ให้ fallback เป็นสินค้าที่เรียงตามรีวิว
+        self.fallback_results = tuple(
+            sorted(self.products, key=lambda p: p['review'] or '', reverse=True))
+
+    def search(self, intent, limit=PRODUCT_RESULT_LIMIT):
+        # ถ้าไม่เจอ intent ที่ตรงกัน ให้แสดงสินค้าทั้งหมด
+        results = self.intent_results.get(intent, self.products)
+        if not results:
+            results = self.fallback_results
+        return list(results[:limit])
+
+class ProductCatalog:
+    """Holds the current CatalogSnapshot and swaps in a new one on refresh"""
+    def __init__(self, refresh_interval=CATALOG_REFRESH_SECONDS):
+        self.refresh_interval = refresh_interval
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self._refresher = None
+
+    @property
+    def snapshot(self):
+        if self._snapshot is None:
+            self.refresh()
+        return self._snapshot
+
+    def refresh(self, force=False):
+        """Reload the snapshot, skipping the full read when the catalog version has not changed"""
+        with self._lock:
+            records = graph.read(CATALOG_VERSION_QUERY)
+            version = records[0]['version'] if records else None
+            current = self._snapshot
+            if not force and current is not None and version is not None and version == current.version:
+                return current
+            products = graph.read(CATALOG_QUERY)
+            self._snapshot = CatalogSnapshot(products, version)
+        print(f"Catalog snapshot loaded: {len(self._snapshot.products)} products, version {version}")
+        return self._snapshot
+
+    def start_auto_refresh(self):
+        if self.refresh_interval <= 0 or self._refresher is not None:
+            return
+        self._refresher = threading.Thread(target=self._refresh_loop, name='catalog-refresh', daemon=True)
+        self._refresher.start()
+
+    def _refresh_loop(self):
+        while True:
+            time.sleep(self.refresh_interval)
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"Catalog refresh error: {e}")
+
+product_catalog = ProductCatalog()
+catalog_loader = LazyResource('catalog', product_catalog.refresh)
+
+# Price / size / rating filters ("ต่ำกว่า 3000 บาท", "30ml", "rating >= 4.5")
+PRICE_AMOUNT = r'(\d[\d,]*)\s*(k\b|พัน)?'
+PRICE_UNIT = r'\s*(?:บาท|baht|thb|฿)'
+# After a comparator the unit is optional, as long as the number is not a size, a rating or a decimal
+PRICE_NOT_OTHER_UNIT = r'(?![\d,]|\.\d|\s*(?:ml|ดาว|stars?|/5))'
+PRICE_RANGE_PATTERN = re.compile(PRICE_AMOUNT + r'\s*(?:-|ถึง|to)\s*' + PRICE_AMOUNT + PRICE_UNIT)
+MAX_PRICE_PATTERN = re.compile(
+    r'(?:under|below|less than|at most|max|<=?|≤|ต่ำกว่า|ไม่เกิน|น้อยกว่า|ไม่ถึง|งบ|budget)\s*' + PRICE_AMOUNT
+    + PRICE_NOT_OTHER_UNIT + r'(?:' + PRICE_UNIT + r')?')
+MIN_PRICE_PATTERN = re.compile(
+    r'(?:over|above|more than|at least|>=?|≥|มากกว่า|(?<!ไม่)เกิน|ตั้งแต่)\s*' + PRICE_AMOUNT
+    + PRICE_NOT_OTHER_UNIT + r'(?:' + PRICE_UNIT + r')?'
+    + r'|' + PRICE_AMOUNT + PRICE_UNIT + r'\s*(?:ขึ้นไป|up|\+)')
+SIZE_PATTERN = re.compile(r'(\d+(?:\.\d+)?)\s*ml\b')
+# A bare number after "รีวิว"/"rating" is not a rating ("มีรีวิว 5 อันดับ"): it needs a comparator,
+# a decimal, "ขึ้นไป", or a star unit
+MIN_RATING_PATTERN = re.compile(
+    r'(?:rating|rated|review|รีวิว|คะแนน|เรตติ้ง)\s*(?:'
+    r'(?:>=|≥|>|at least|ตั้งแต่)\s*([0-5](?:\.\d)?)(?!\d)'
+    r'|([0-5]\.\d)(?!\d)'
+    r'|([0-5](?:\.\d)?)\s*(?:ขึ้นไป|up\b|\+))'
+    r'|([0-5](?:\.\d)?)\s*(?:ดาว|stars?|/5)')
+
+def parse_amount(number, unit=None):
+    value = int(number.replace(',', ''))
+    return value * 1000 if unit else value
+
+def parse_single_amount(match):
+    amount = re.search(PRICE_AMOUNT, match.group(0))
+    return parse_amount(amount.group(1), amount.group(2))
+
+def parse_product_filters(text):
+    """Numeric constraints in a chat message -> {min_price, max_price, size_ml, min_rating}"""
+    text = text.lower()
+    filters = {}
+    price_range = PRICE_RANGE_PATTERN.search(text)
+    if price_range:
+        low_number, low_unit, high_number, high_unit = price_range.groups()
+        # "1-2 พันบาท": the unit after the upper bound also applies to the lower one
+        if high_unit and not low_unit and parse_amount(low_number) <= parse_amount(high_number):
+            low_unit = high_unit
+        low = parse_amount(low_number, low_unit)
+        high = parse_amount(high_number, high_unit)
+        filters['min_price'], filters['max_price'] = min(low, high), max(low, high)
+    else:
+        max_price = MAX_PRICE_PATTERN.search(text)
+        if max_price:
+            filters['max_price'] = parse_single_amount(max_price)
+        min_price = MIN_PRICE_PATTERN.search(text)
+        if min_price:
+            filters['min_price'] = parse_single_amount(min_price)
+    size = SIZE_PATTERN.search(text)
+    if size:
+        filters['size_ml'] = float(size.group(1))
+    rating = MIN_RATING_PATTERN.search(text)
+    if rating:
+        filters['min_rating'] = float(next(value for value in rating.groups() if value))
+    return filters
+
+# Each condition is a plain comparison on an indexed property so Neo4j can use the range indexes
+PRODUCT_FILTER_CONDITIONS = {
+    'min_price': 'p.price_thb >= $min_price',
+    'max_price': 'p.price_thb <= $max_price',
+    'size_ml': 'p.size_ml = $size_ml',
+    'min_rating': 'p.rating >= $min_rating',
+}
+
+def filter_product_keys(filters):
+    """Keys of the products matching filters, best rated first"""
+    conditions = ' AND '.join(PRODUCT_FILTER_CONDITIONS[name] for name in filters)
+    query = f"""
+    MATCH (p:Product) WHERE {conditions}
+    RETURN p.product_key AS product_key
+    ORDER BY coalesce(p.rating, 0) DESC, p.price_thb
+    """
+    return [record['product_key'] for record in graph.read(query, **filters)]
 
 # Enhanced product search with better Thai-English support
-def search_products_by_intent(intent, query=""):
-    query_string = ""
-    
-    if intent == "product_bestseller":
-        query_string = """
-        MATCH (p:Product)-[:HAS_STATUS]->(s:Status {name: 'BESTSELLER'}) 
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "product_new":
-        query_string = """
-        MATCH (p:Product)-[:HAS_STATUS]->(s:Status {name: 'NEW'}) 
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "product_reviewed":
-        query_string = """
-        MATCH (p:Product)
-        WHERE p.review IS NOT NULL 
-        AND p.review <> '' 
-        AND p.review <> 'No Review'
-        AND NOT p.review =~ '.*No Review.*'
-        AND p.review =~ '.*[0-9]+.*'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        ORDER BY 
-          CASE 
-            WHEN p.review =~ '5(\\.0)?/5' THEN 5.0
-            WHEN p.review =~ '4\\.[5-9]/5' THEN 4.7
-            WHEN p.review =~ '4\\.[0-4]/5' THEN 4.2
-            WHEN p.review =~ '3\\.[5-9]/5' THEN 3.7
-            ELSE 0.0
-          END DESC
-        LIMIT 5
-        """
-    elif intent == "product_limited":
-        query_string = """
-        MATCH (p:Product)-[:HAS_STATUS]->(s:Status {name: 'Limited Edition'}) 
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "scent_fresh":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'fresh' OR toLower(p.title) CONTAINS 'light' OR 
-              toLower(p.title) CONTAINS 'citrus' OR toLower(p.title) CONTAINS 'ocean' OR
-              toLower(p.title) CONTAINS 'clean' OR toLower(p.title) CONTAINS 'cool' OR
-              toLower(p.title) CONTAINS 'aqua' OR toLower(p.title) CONTAINS 'blue' OR
-              toLower(p.title) CONTAINS 'mint' OR toLower(p.title) CONTAINS 'green' OR
-              p.title CONTAINS 'สดชื่น' OR p.title CONTAINS 'เซฟ' OR 
-              p.title CONTAINS 'เบา' OR p.title CONTAINS 'ใส' OR
-              p.title CONTAINS 'น้ำใส' OR p.title CONTAINS 'ทะเล' OR
-              p.title CONTAINS 'เย็น' OR p.title CONTAINS 'สด'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "scent_sweet":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'sweet' OR toLower(p.title) CONTAINS 'vanilla' OR 
-              toLower(p.title) CONTAINS 'floral' OR toLower(p.title) CONTAINS 'rose' OR
-              toLower(p.title) CONTAINS 'flower' OR toLower(p.title) CONTAINS 'pink' OR
-              toLower(p.title) CONTAINS 'cherry' OR toLower(p.title) CONTAINS 'peach' OR
-              p.title CONTAINS 'หวาน' OR p.title CONTAINS 'ดอกไม้' OR 
-              p.title CONTAINS 'กุหลาบ' OR p.title CONTAINS 'หอม' OR
-              p.title CONTAINS 'วานิลลา' OR p.title CONTAINS 'ชมพู'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "scent_sexy":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'intense' OR toLower(p.title) CONTAINS 'black' OR 
-              toLower(p.title) CONTAINS 'noir' OR toLower(p.title) CONTAINS 'dark' OR
-              toLower(p.title) CONTAINS 'deep' OR toLower(p.title) CONTAINS 'red' OR
-              toLower(p.title) CONTAINS 'sexy' OR toLower(p.title) CONTAINS 'seductive' OR
-              p.title CONTAINS 'เซ็กซี่' OR p.title CONTAINS 'ดำ' OR 
-              p.title CONTAINS 'เข้ม' OR p.title CONTAINS 'แรง' OR
-              p.title CONTAINS 'ดึงดูด' OR p.title CONTAINS 'แดง'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "season_summer":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'fresh' OR toLower(p.title) CONTAINS 'light' OR 
-              toLower(p.title) CONTAINS 'citrus' OR toLower(p.title) CONTAINS 'ocean' OR
-              toLower(p.title) CONTAINS 'cool' OR toLower(p.title) CONTAINS 'aqua' OR
-              toLower(p.title) CONTAINS 'blue' OR toLower(p.title) CONTAINS 'summer' OR
-              toLower(p.title) CONTAINS 'mint' OR toLower(p.title) CONTAINS 'ice' OR
-              p.title CONTAINS 'สดชื่น' OR p.title CONTAINS 'เซฟ' OR 
-              p.title CONTAINS 'เบา' OR p.title CONTAINS 'ร้อน' OR
-              p.title CONTAINS 'เย็น' OR p.title CONTAINS 'สด'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "season_winter":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'warm' OR toLower(p.title) CONTAINS 'intense' OR 
-              toLower(p.title) CONTAINS 'rich' OR toLower(p.title) CONTAINS 'deep' OR
-              toLower(p.title) CONTAINS 'dark' OR toLower(p.title) CONTAINS 'winter' OR
-              toLower(p.title) CONTAINS 'spice' OR toLower(p.title) CONTAINS 'wood' OR
-              p.title CONTAINS 'อุ่น' OR p.title CONTAINS 'เข้ม' OR 
-              p.title CONTAINS 'หนาว' OR p.title CONTAINS 'แรง' OR
-              p.title CONTAINS 'เครื่องเทศ' OR p.title CONTAINS 'ไม้'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "occasion_work":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'light' OR toLower(p.title) CONTAINS 'fresh' OR 
-              toLower(p.title) CONTAINS 'clean' OR toLower(p.title) CONTAINS 'subtle' OR
-              toLower(p.title) CONTAINS 'office' OR toLower(p.title) CONTAINS 'work' OR
-              toLower(p.title) CONTAINS 'professional' OR toLower(p.title) CONTAINS 'classic' OR
-              p.title CONTAINS 'เบา' OR p.title CONTAINS 'เซฟ' OR 
-              p.title CONTAINS 'ทำงาน' OR p.title CONTAINS 'ออฟฟิศ' OR
-              p.title CONTAINS 'เรียบร้อย' OR p.title CONTAINS 'สุภาพ'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "occasion_date":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'romance' OR toLower(p.title) CONTAINS 'love' OR 
-              toLower(p.title) CONTAINS 'sexy' OR toLower(p.title) CONTAINS 'seductive' OR
-              toLower(p.title) CONTAINS 'date' OR toLower(p.title) CONTAINS 'heart' OR
-              toLower(p.title) CONTAINS 'passion' OR toLower(p.title) CONTAINS 'charm' OR
-              p.title CONTAINS 'โรแมนติก' OR p.title CONTAINS 'รัก' OR 
-              p.title CONTAINS 'เดท' OR p.title CONTAINS 'หัวใจ' OR
-              p.title CONTAINS 'ดึงดูด' OR p.title CONTAINS 'เสน่ห์'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    elif intent == "occasion_party":
-        query_string = """
-        MATCH (p:Product)
-        WHERE toLower(p.title) CONTAINS 'intense' OR toLower(p.title) CONTAINS 'bold' OR 
-              toLower(p.title) CONTAINS 'strong' OR toLower(p.title) CONTAINS 'party' OR
-              toLower(p.title) CONTAINS 'night' OR toLower(p.title) CONTAINS 'club' OR
-              toLower(p.title) CONTAINS 'celebration' OR toLower(p.title) CONTAINS 'festive' OR
-              p.title CONTAINS 'ปาร์ตี้' OR p.title CONTAINS 'แรง' OR 
-              p.title CONTAINS 'เลี้ยง' OR p.title CONTAINS 'กลางคืน' OR
-              p.title CONTAINS 'สนุก' OR p.title CONTAINS 'เฟส'
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
+def search_products_by_intent(intent, filters=None):
+    snapshot = product_catalog.snapshot
+    if filters:
+        keys = filter_product_keys(filters)
+        if intent in snapshot.intent_results:
+            # Keep the intent's own ordering, restricted to products that pass the filters
+            allowed = set(keys)
+            products = [p for p in snapshot.intent_results[intent] if product_key(p) in allowed]
+        else:
+            products = [snapshot.by_key[key] for key in keys if key in snapshot.by_key]
+        return products[:PRODUCT_RESULT_LIMIT]
+    return snapshot.search(intent)
+
+# Semantic product search over title + note embeddings
+PRODUCT_INDEX_PATH = os.environ.get('PRODUCT_INDEX_PATH', 'product_index.faiss')
+PRODUCT_INDEX_TYPE = os.environ.get('PRODUCT_INDEX_TYPE', 'auto')  # auto, flat, ivf or hnsw
+BUILD_PRODUCT_INDEX = os.environ.get('BUILD_PRODUCT_INDEX', '0') == '1'
+SEMANTIC_MIN_SCORE = float(os.environ.get('SEMANTIC_MIN_SCORE', '0.5'))
+LARGE_CATALOG_SIZE = 10000  # switch from exact search to IVF past this many products
+IVF_NPROBE = 16
+HNSW_EF_SEARCH = 64
+
+def product_document(product):
+    """Text that represents a product in embedding space"""
+    parts = [product['title'], product.get('top_note'), product.get('heart_note'), product.get('base_note')]
+    return ' '.join(part for part in parts if part)
+
+def create_faiss_index(dimension, count, index_type=PRODUCT_INDEX_TYPE):
+    import faiss
+    if index_type == 'auto':
+        index_type = 'ivf' if count >= LARGE_CATALOG_SIZE else 'flat'
+    if index_type == 'flat':
+        return faiss.IndexFlatIP(dimension)
+    if index_type == 'ivf':
+        nlist = max(1, int(4 * np.sqrt(count)))
+        return faiss.index_factory(dimension, f"IVF{nlist},Flat", faiss.METRIC_INNER_PRODUCT)
+    if index_type == 'hnsw':
+        return faiss.index_factory(dimension, "HNSW32,Flat", faiss.METRIC_INNER_PRODUCT)
+    raise ValueError(f"Unknown product index type: {index_type}")
+
+def encode_normalized(texts, cached=True):
+    """L2-normalized embeddings; cached=False for one-off texts such as user messages"""
+    if cached:
+        vectors = embedding_store.encode(list(texts))
     else:
-        # ถ้าไม่เจอ intent ที่ตรงกัน ให้แสดงสินค้าทั้งหมด
-        query_string = """
-        MATCH (p:Product)
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        LIMIT 5
-        """
-    
-    result = graph.run(query_string).data()
-    
-    # ถ้าไม่มีผลลัพธ์ ให้ fallback เป็นการแสดงสินค้าทั้งหมด
-    if not result:
-        fallback_query = """
-        MATCH (p:Product)
-        RETURN p.title AS title, p.price AS price, p.size AS size, 
-               p.image_url AS image_url, p.review AS review, p.stock AS stock
-        ORDER BY p.review DESC
-        LIMIT 5
-        """
-        result = graph.run(fallback_query).data()
-    
-    return result
+        vectors = np.asarray(encoder.encode(list(texts)), dtype='float32')
+    # Same as faiss.normalize_L2, without importing faiss on the request path
+    vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    return vectors
+
+class MessageEmbedding:
+    """One user message, embedded at most once per request and shared by every semantic step"""
+    def __init__(self, text):
+        self.text = text
+        self._vector = None
+
+    @property
+    def vector(self):
+        if self._vector is None:
+            self._vector = encode_normalized([self.text], cached=False)
+        return self._vector
+
+class ProductVectorIndex:
+    """FAISS inner-product index over normalized product embeddings, saved next to its row keys"""
+    def __init__(self, index, keys):
+        self.index = index
+        self.keys = keys
+        if hasattr(index, 'nprobe'):
+            index.nprobe = IVF_NPROBE
+        if hasattr(index, 'hnsw'):
+            index.hnsw.efSearch = HNSW_EF_SEARCH
+
+    @classmethod
+    def build(cls, products, index_type=PRODUCT_INDEX_TYPE):
+        vectors = encode_normalized(product_document(p) for p in products)
+        index = create_faiss_index(vectors.shape[1], len(vectors), index_type)
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        return cls(index, [product_key(p) for p in products])
+
+    @classmethod
+    def load(cls, path):
+        import faiss
+        with open(path + '.keys.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta['model'] != encoder.model_name:
+            raise ValueError(f"{path} was built with {meta['model']}, not {encoder.model_name}")
+        return cls(faiss.read_index(path), meta['keys'])
+
+    def save(self, path):
+        import faiss
+        faiss.write_index(self.index, path)
+        with open(path + '.keys.json', 'w', encoding='utf-8') as f:
+            json.dump({'model': encoder.model_name, 'keys': self.keys}, f, ensure_ascii=False)
+
+    def search(self, vectors, k):
+        scores, ids = self.index.search(vectors, k)
+        return [(self.keys[i], float(score)) for i, score in zip(ids[0], scores[0]) if i != -1]
+
+def load_product_index():
+    """Build the index when BUILD_PRODUCT_INDEX=1, otherwise load the saved one"""
+    if BUILD_PRODUCT_INDEX:
+        index = ProductVectorIndex.build(product_catalog.snapshot.products)
+        index.save(PRODUCT_INDEX_PATH)
+        print(f"Product index built: {len(index.keys)} products -> {PRODUCT_INDEX_PATH}")
+        return index
+    if os.path.exists(PRODUCT_INDEX_PATH):
+        return ProductVectorIndex.load(PRODUCT_INDEX_PATH)
+    print(f"No product index at {PRODUCT_INDEX_PATH}, semantic search disabled")
+    return None
+
+product_index = LazyResource('product index', load_product_index)
+
+def search_products_semantic(query, k=PRODUCT_RESULT_LIMIT, min_score=SEMANTIC_MIN_SCORE):
+    """Top-k products whose title and notes are closest to query (a str or a MessageEmbedding)"""
+    index = product_index.get()
+    if index is None:
+        return []
+    if not isinstance(query, MessageEmbedding):
+        query = MessageEmbedding(query)
+    snapshot = product_catalog.snapshot
+    products = []
+    for key, score in index.search(query.vector, k):
+        # Rows that left the catalog since the index was built are skipped
+        if score >= min_score and key in snapshot.by_key:
+            products.append(snapshot.by_key[key])
+    return products
+
+# "More like this": top-k neighbours per product, precomputed offline and served from memory
+SIMILAR_PRODUCTS_PATH = os.environ.get('SIMILAR_PRODUCTS_PATH', 'similar_products.json')
+BUILD_SIMILAR_PRODUCTS = os.environ.get('BUILD_SIMILAR_PRODUCTS', '0') == '1'
+SIMILAR_PRODUCTS_K = 5
+SIMILARITY_NOTE_WEIGHT = float(os.environ.get('SIMILARITY_NOTE_WEIGHT', '0.5'))  # rest goes to embeddings
+SIMILAR_TITLE_OVERSAMPLE = 4  # candidates looked at per neighbour kept, so repeated sizes can be skipped
+SIMILARITY_BLOCK_ROWS = 1024  # rows of the n x n score matrix held in memory at once
+
+def ingredient_matrix(products):
+    """Binary product x ingredient matrix over the ingredient keys from the catalog"""
+    vocabulary = {}
+    for p in products:
+        for ingredient in p.get('ingredients') or ():
+            vocabulary.setdefault(ingredient, len(vocabulary))
+    matrix = np.zeros((len(products), max(1, len(vocabulary))), dtype='float32')
+    for row, p in enumerate(products):
+        for ingredient in p.get('ingredients') or ():
+            matrix[row, vocabulary[ingredient]] = 1.0
+    return matrix
+
+class SimilarProducts:
+    """Neighbour lists keyed by product_key; lookup is a dict access"""
+    def __init__(self, neighbors, version=None):
+        self.neighbors = neighbors
+        self.version = version
+
+    @classmethod
+    def build(cls, products, k=SIMILAR_PRODUCTS_K, note_weight=SIMILARITY_NOTE_WEIGHT, version=None):
+        """Score = note_weight * ingredient Jaccard + (1 - note_weight) * embedding cosine"""
+        products = list(products)
+        keys = [product_key(p) for p in products]
+        titles = np.array([p['title'] for p in products], dtype=object)
+        ingredients = ingredient_matrix(products)
+        sizes = ingredients.sum(axis=1)
+        embeddings = encode_normalized(product_document(p) for p in products)
+        k = min(k, len(products) - 1)
+
+        neighbors = {}
+        for start in range(0, len(products), SIMILARITY_BLOCK_ROWS):
+            end = min(start + SIMILARITY_BLOCK_ROWS, len(products))
+            shared = ingredients[start:end] @ ingredients.T
+            union = sizes[start:end, None] + sizes[None, :] - shared
+            jaccard = np.divide(shared, union, out=np.zeros_like(shared), where=union > 0)
+            scores = note_weight * jaccard + (1 - note_weight) * (embeddings[start:end] @ embeddings.T)
+            # Other sizes of the same fragrance are not "more like this"
+            scores[titles[start:end, None] == titles[None, :]] = -np.inf
+            for row in range(end - start):
+                neighbors[keys[start + row]] = [keys[c] for c in cls._top_distinct(scores[row], titles, k)]
+        return cls(neighbors, version)
+
+    @staticmethod
+    def _top_distinct(row_scores, titles, k):
+        """Columns of the k best scores, keeping only the best-scoring size of each title"""
+        if k <= 0:
+            return []
+        # Usually the best few candidates already hold k titles; sort the whole row only if not
+        candidates = min(len(row_scores), k * SIMILAR_TITLE_OVERSAMPLE)
+        while True:
+            top = np.argpartition(-row_scores, candidates - 1)[:candidates]
+            top = top[np.argsort(-row_scores[top], kind='stable')]
+            columns, seen = [], set()
+            for column in top:
+                if not np.isfinite(row_scores[column]) or titles[column] in seen:
+                    continue
+                seen.add(titles[column])
+                columns.append(column)
+                if len(columns) == k:
+                    return columns
+            if candidates == len(row_scores):
+                return columns
+            candidates = len(row_scores)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        if data['model'] != encoder.model_name:
+            raise ValueError(f"{path} was built with {data['model']}, not {encoder.model_name}")
+        return cls(data['neighbors'], data.get('version'))
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': encoder.model_name, 'version': self.version, 'neighbors': self.neighbors},
+                      f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def lookup(self, key):
+        return self.neighbors.get(key, [])
+
+def load_similar_products():
+    """Build the neighbour lists when BUILD_SIMILAR_PRODUCTS=1, otherwise load the saved ones"""
+    if BUILD_SIMILAR_PRODUCTS:
+        snapshot = product_catalog.snapshot
+        similar = SimilarProducts.build(snapshot.products, version=snapshot.version)
+        similar.save(SIMILAR_PRODUCTS_PATH)
+        print(f"Similar products built: {len(similar.neighbors)} products -> {SIMILAR_PRODUCTS_PATH}")
+        return similar
+    if os.path.exists(SIMILAR_PRODUCTS_PATH):
+        return SimilarProducts.load(SIMILAR_PRODUCTS_PATH)
+    print(f"No similar products at {SIMILAR_PRODUCTS_PATH}, \"more like this\" disabled")
+    return None
+
+similar_products = LazyResource('similar products', load_similar_products)
+
+def get_similar_products(product, limit=SIMILAR_PRODUCTS_K):
+    """Precomputed neighbours of product that are still in the catalog"""
+    similar = similar_products.get()
+    if similar is None:
+        return []
+    snapshot = product_catalog.snapshot
+    keys = similar.lookup(product_key(product))
+    return [snapshot.by_key[key] for key in keys if key in snapshot.by_key][:limit]
+
+# Personalized "แนะนำ": per-user top-N lists from ADDED_TO_CART, computed offline by build_recommendations.py
+USER_RECOMMENDATIONS_PATH = os.environ.get('USER_RECOMMENDATIONS_PATH', 'user_recommendations.json')
+USER_RECOMMENDATIONS_N = 10
+
+CART_EDGES_QUERY = """
+MATCH (u:User)-[r:ADDED_TO_CART]->(p:Product)
+WHERE p.product_key IS NOT NULL
+RETURN u.user_id AS user_id, p.product_key AS product_key, coalesce(r.quantity, 1) AS quantity
+"""
+
+class UserRecommendations:
+    """Item-item cosine collaborative filtering over the user x product cart matrix"""
+    def __init__(self, recommendations, version=None, path=None):
+        self.recommendations = recommendations
+        self.version = version
+        self.path = path
+        self.mtime = os.path.getmtime(path) if path else None
+
+    @classmethod
+    def build(cls, edges, n=USER_RECOMMENDATIONS_N, version=None):
+        """edges: dicts with user_id, product_key and quantity (one per ADDED_TO_CART edge)"""
+        from scipy import sparse
+        users, items = {}, {}
+        rows, columns, values = [], [], []
+        for edge in edges:
+            rows.append(users.setdefault(edge['user_id'], len(users)))
+            columns.append(items.setdefault(edge['product_key'], len(items)))
+            values.append(np.log1p(max(edge['quantity'] or 1, 1)))  # implicit-feedback confidence
+        if not users:
+            return cls({}, version)
+        matrix = sparse.csr_matrix((values, (rows, columns)), shape=(len(users), len(items)), dtype='float32')
+        matrix.sum_duplicates()
+
+        # Cosine similarity between item columns; an item is not its own neighbour
+        norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=0))).ravel()
+        normalized = matrix @ sparse.diags(1.0 / np.maximum(norms, 1e-12))
+        item_similarity = (normalized.T @ normalized).tocsr()
+        item_similarity.setdiag(0)
+        item_similarity.eliminate_zeros()
+
+        scores = (matrix @ item_similarity).tocsr()
+        # Already-carted products are not recommended again
+        scores = scores - scores.multiply(matrix > 0)
+        scores.eliminate_zeros()
+
+        user_keys = list(users)
+        item_keys = list(items)
+        recommendations = {}
+        for user in range(scores.shape[0]):
+            start, end = scores.indptr[user], scores.indptr[user + 1]
+            if start == end:
+                continue
+            data, indices = scores.data[start:end], scores.indices[start:end]
+            top = [i for i in np.argsort(-data, kind='stable')[:n] if data[i] > 0]
+            if top:
+                recommendations[user_keys[user]] = [item_keys[i] for i in indices[top]]
+        return cls(recommendations, version)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data['recommendations'], data.get('version'), path)
+
+    def reload_if_changed(self):
+        """Pick up a file republished by the batch job (swaps the dict, never mutates it)"""
+        if not self.path or not os.path.exists(self.path) or os.path.getmtime(self.path) == self.mtime:
+            return
+        fresh = UserRecommendations.load(self.path)
+        self.recommendations, self.version, self.mtime = fresh.recommendations, fresh.version, fresh.mtime
+        print(f"User recommendations reloaded: {len(self.recommendations)} users")
+
+    def save(self, path):
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': self.version, 'recommendations': self.recommendations}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def lookup(self, user_id):
+        return self.recommendations.get(user_id, [])
+
+def load_user_recommendations():
+    if os.path.exists(USER_RECOMMENDATIONS_PATH):
+        return UserRecommendations.load(USER_RECOMMENDATIONS_PATH)
+    print(f"No user recommendations at {USER_RECOMMENDATIONS_PATH}, personalized results disabled")
+    return None
+
+user_recommendations = LazyResource('user recommendations', load_user_recommendations)
+
+def get_personal_recommendations(user_id, limit=PRODUCT_RESULT_LIMIT):
+    """Published top-N for user_id that are still in the catalog (no graph query)"""
+    recommendations = user_recommendations.get()
+    if recommendations is None:
+        return []
+    try:
+        recommendations.reload_if_changed()
+    except Exception as e:
+        print(f"User recommendations reload error: {e}")
+    snapshot = product_catalog.snapshot
+    keys = recommendations.lookup(user_id)
+    return [snapshot.by_key[key] for key in keys if key in snapshot.by_key][:limit]
 
 # Enhanced intent response messages (Thai-English friendly)
 def get_intent_response_message(intent):
@@ -528,116 +1470,204 @@ def get_intent_response_message(intent):
         'product_new': 'แนะนำน้ำหอมใหม่ (New Arrivals) สำหรับคุณค่ะ: ✨',
         'product_reviewed': 'แนะนำน้ำหอมที่มี Review ดีสำหรับคุณค่ะ: 👍',
         'product_limited': 'แนะนำน้ำหอม Limited Edition สำหรับคุณค่ะ: 💎',
+        'product_filter': 'น้ำหอมที่ตรงกับเงื่อนไขของคุณค่ะ: 🔎',
     }
     return responses.get(intent, 'ขอโทษค่ะ ฉันไม่เข้าใจคำถามของคุณ กรุณาลองถามใหม่หรือเลือกจากตัวเลือกที่มีค่ะ')
 
-# Basic FAISS for fallback
-basic_data = [['สวัสดี', 'สวัสดีค่ะ'], ['ayyo', 'ayyo']]
-basic_df = pd.DataFrame(basic_data, columns=['text', 'category'])
-basic_text = basic_df['text']
-basic_vectors = encoder.encode(basic_text)
-basic_vector_dimension = basic_vectors.shape[1]
-basic_index = faiss.IndexFlatL2(basic_vector_dimension)
-faiss.normalize_L2(basic_vectors)
-basic_index.add(basic_vectors)
-
-# Function to get all product titles as a corpus
-def get_product_titles_as_corpus():
-    query_string = """
-    MATCH (p:Product)
-    RETURN p.title AS title
-    """
-    result = graph.run(query_string).data()
-    corpus = [record['title'] for record in result if 'title' in record]
-    return corpus
+# Nearest-neighbour fallback for low-confidence messages: every intent_data example plus FAQ answers
+# Built offline by build_product_index.py; workers only load it
+INTENT_FAQ_INDEX_PATH = os.environ.get('INTENT_FAQ_INDEX_PATH', 'intent_faq_index.faiss')
+BUILD_INTENT_FAQ_INDEX = os.environ.get('BUILD_INTENT_FAQ_INDEX', '0') == '1'
+FAQ_MIN_SCORE = float(os.environ.get('FAQ_MIN_SCORE', '0.8'))  # cosine; same cut-off as the old L2 distance <= 0.4
 
-corpus = get_product_titles_as_corpus()
-print("Product Titles Corpus:", corpus)
+faq_data = [
+    ['สวัสดี', 'สวัสดีค่ะ'],
+    ['ดูตะกร้ายังไง', 'พิมพ์ /cart หรือ ตะกร้า เพื่อดูสินค้าในตะกร้าได้เลยค่ะ 🛒'],
+    ['สั่งซื้อยังไง', 'พิมพ์ /checkout หรือ สั่งซื้อ เพื่อเริ่มขั้นตอนการสั่งซื้อค่ะ 💳'],
+    ['ล้างตะกร้ายังไง', 'พิมพ์ /clear_cart หรือ ล้างตะกร้า เพื่อล้างตะกร้าสินค้าค่ะ 🗑️'],
+    ['ติดต่อพนักงาน', '📞 ติดต่อทีมขาย: 02-xxx-xxxx\n💬 LINE: @perfumeshop'],
+]
 
-# Function to get product details by title
-def get_product_details_by_title(title):
-    print(f"=== PRODUCT QUERY DEBUG ===")
-    print(f"Searching for product title: '{title}'")
-    
-    # First try exact match
-    query_string = f"""
-    MATCH (p:Product {{title: $title}})
-    RETURN p.title AS title, p.price AS price, p.size AS size, 
-           p.image_url AS image_url, p.review AS review, p.stock AS stock
-    LIMIT 1
-    """
-    
-    print(f"Query: {query_string}")
-    print(f"Parameter: title = '{title}'")
-    
+FaqMatch = namedtuple('FaqMatch', ['text', 'intent', 'answer', 'score'])
+
+def faq_entries():
+    """(text, intent, answer) rows; FAQ rows carry an answer, intent examples do not"""
+    entries = [[question, 'faq', answer] for question, answer in faq_data]
+    entries.extend([text, intent, None] for text, intent in intent_data)
+    return entries
+
+class IntentFaqIndex:
+    """Inner-product FAISS index over normalized embeddings of faq_entries(), saved with its rows"""
+    def __init__(self, index, entries):
+        self.index = index
+        self.entries = entries
+
+    @staticmethod
+    def fingerprint(entries):
+        content = json.dumps([encoder.model_name, entries], ensure_ascii=False)
+        return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def build(cls, entries):
+        import faiss
+        vectors = encode_normalized(text for text, _, _ in entries)
+        index = faiss.IndexFlatIP(vectors.shape[1])
+        index.add(vectors)
+        return cls(index, entries)
+
+    @classmethod
+    def load(cls, path, entries):
+        """Saved index, or None when it is missing or was built from other entries / another model"""
+        import faiss
+        if not os.path.exists(path) or not os.path.exists(path + '.meta.json'):
+            return None
+        with open(path + '.meta.json', encoding='utf-8') as f:
+            meta = json.load(f)
+        if meta.get('fingerprint') != cls.fingerprint(entries):
+            return None
+        index = faiss.read_index(path)
+        if index.ntotal != len(meta['entries']):  # index and meta from different builds
+            return None
+        return cls(index, meta['entries'])
+
+    def save(self, path):
+        import faiss
+        # Write both files aside, then swap them in so a loading worker never sees a partial file
+        faiss.write_index(self.index, path + '.tmp')
+        with open(path + '.meta.json.tmp', 'w', encoding='utf-8') as f:
+            json.dump({'fingerprint': self.fingerprint(self.entries), 'entries': self.entries}, f, ensure_ascii=False)
+        os.replace(path + '.tmp', path)
+        os.replace(path + '.meta.json.tmp', path + '.meta.json')
+
+    def search(self, message_embedding):
+        scores, ids = self.index.search(message_embedding.vector, 1)
+        if ids[0][0] == -1:
+            return None
+        text, intent, answer = self.entries[ids[0][0]]
+        return FaqMatch(text, intent, answer, float(scores[0][0]))
+
+def load_intent_faq_index():
+    """Build and save the index when BUILD_INTENT_FAQ_INDEX=1, otherwise load the saved one"""
+    entries = faq_entries()
+    if BUILD_INTENT_FAQ_INDEX:
+        index = IntentFaqIndex.build(entries)
+        index.save(INTENT_FAQ_INDEX_PATH)
+        print(f"Intent/FAQ index built: {len(entries)} rows -> {INTENT_FAQ_INDEX_PATH}")
+        return index
+    index = IntentFaqIndex.load(INTENT_FAQ_INDEX_PATH, entries)
+    if index is None:
+        # Missing or stale: build in memory only, never write from a serving worker
+        print(f"No up-to-date intent/FAQ index at {INTENT_FAQ_INDEX_PATH}, building it in memory "
+              f"(run build_product_index.py to save one)")
+        index = IntentFaqIndex.build(entries)
+    return index
+
+intent_faq_index = LazyResource('intent/faq index', load_intent_faq_index)
+
+def match_faq(message_embedding, min_score=FAQ_MIN_SCORE):
+    """Closest FAQ question or intent example, if it is at least min_score similar"""
+    match = intent_faq_index.search(message_embedding)
+    if match is None or match.score < min_score:
+        return None
+    return match
+
+PRODUCT_DETAILS_QUERY = """
+MATCH (p:Product {product_key: $product_key})
+RETURN p.product_key AS product_key, p.title AS title, p.price AS price, p.size AS size,
+       p.image_url AS image_url, p.review AS review, p.stock AS stock
+"""
+
+# Function to get product details by product ID: one lookup on the unique product_key
+def get_product_details(product_id, label=None):
+    label = label or product_id
     try:
-        result = graph.run(query_string, title=title).data()
-        print(f"Query result: {result}")
-        
-        if not result:
-            print(f"No exact match found for '{title}', trying case-insensitive search...")
-            
-            # Try case-insensitive search
-            case_insensitive_query = """
-            MATCH (p:Product)
-            WHERE toLower(p.title) = toLower($title)
-            RETURN p.title AS title, p.price AS price, p.size AS size, 
-                   p.image_url AS image_url, p.review AS review, p.stock AS stock
-            LIMIT 1
-            """
-            
-            result = graph.run(case_insensitive_query, title=title).data()
-            print(f"Case-insensitive result: {result}")
-            
-            if not result:
-                print(f"Still no match, trying partial match...")
-                
-                # Try partial match
-                partial_query = """
-                MATCH (p:Product)
-                WHERE p.title CONTAINS $title OR toLower(p.title) CONTAINS toLower($title)
-                RETURN p.title AS title, p.price AS price, p.size AS size, 
-                       p.image_url AS image_url, p.review AS review, p.stock AS stock
-                LIMIT 1
-                """
-                
-                result = graph.run(partial_query, title=title).data()
-                print(f"Partial match result: {result}")
-        
-        if not result:
-            print(f"No product found with title containing '{title}'")
-            return f"ไม่พบสินค้าที่ชื่อ '{title}'"
-        
-        product = result[0]
-        print(f"Found product: {product}")
-        
-        product_details = {
-            "title": product['title'],
-            "price": product['price'],
-            "size": product['size'],
-            "image_url": product['image_url'],
-            "review": product['review'],
-            "stock": product['stock']
-        }
-        
-        print(f"Returning product details: {product_details}")
-        print("=== PRODUCT QUERY COMPLETED ===")
-        return product_details
-        
+        result = graph.read(PRODUCT_DETAILS_QUERY, product_key=product_id)
     except Exception as e:
         print(f"Database query error: {e}")
         import traceback
         print(f"Traceback: {traceback.format_exc()}")
-        return f"เกิดข้อผิดพลาดในการค้นหาสินค้า '{title}'"
+        return f"เกิดข้อผิดพลาดในการค้นหาสินค้า '{label}'"
+
+    if not result:
+        print(f"Product {product_id} is no longer in the database")
+        return f"ไม่พบสินค้าที่ชื่อ '{label}'"
+    return result[0]
+
+# Function to get product details by title: what the user typed is resolved in memory
+# (exact, alias, partial name or typo), then one get_product_details lookup
+def get_product_details_by_title(title):
+    match = product_catalog.snapshot.titles.resolve(title)
+    if match is None:
+        print(f"No product title matches '{title}'")
+        return f"ไม่พบสินค้าที่ชื่อ '{title}'"
+    print(f"Resolved '{title}' -> '{match.title}' ({match.kind})")
+    return get_product_details(match.product_key, title)
+
+# Rendered Flex messages, shared between replies until the catalog snapshot changes
+FLEX_CACHE_SIZE = int(os.environ.get('FLEX_CACHE_SIZE', '512'))
+
+class RenderedFlexMessage(FlexSendMessage):
+    """FlexSendMessage whose JSON dict is built once; instances are shared, so never mutate one"""
+    def __init__(self, alt_text, contents):
+        super().__init__(alt_text=alt_text, contents=contents)
+        self._json_dict = super().as_json_dict()
+
+    def as_json_dict(self):
+        return self._json_dict
+
+class FlexMessageCache:
+    """LRU of rendered messages, emptied whenever product_catalog swaps in a new snapshot"""
+    def __init__(self, max_size=FLEX_CACHE_SIZE):
+        self.max_size = max_size
+        self._messages = OrderedDict()
+        self._snapshot = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_build(self, key, build):
+        snapshot = product_catalog.snapshot
+        with self._lock:
+            if self._snapshot is not snapshot:
+                self._messages.clear()
+                self._snapshot = snapshot
+            message = self._messages.get(key)
+            if message is not None:
+                self._messages.move_to_end(key)
+                self.hits += 1
+                return message
+            self.misses += 1
+        # Built outside the lock; two threads may render the same key once each, which is harmless
+        message = build()
+        with self._lock:
+            if self._snapshot is snapshot:
+                self._messages[key] = message
+                while len(self._messages) > self.max_size:
+                    self._messages.popitem(last=False)
+        return message
+
+flex_cache = FlexMessageCache()
+
+def create_flex_carousel(products):
+    key = ('carousel',) + tuple(product_key(p) for p in products)
+    return flex_cache.get_or_build(key, lambda: render_flex_carousel(products))
+
+def create_detailed_product_card(product):
+    # ปุ่ม "กลิ่นคล้ายกัน" ขึ้นกับว่าโหลด similar products เสร็จหรือยัง
+    key = ('detail', product_key(product), similar_products.ready)
+    return flex_cache.get_or_build(key, lambda: render_detailed_product_card(product))
+
+def postback_data(action, product_id):
+    # urlencode: a product without a SKU falls back to its image URL, which may contain & = ?
+    return urllib.parse.urlencode({'action': action, 'id': product_id})
 
 # Function to create Flex Carousel using product data
 # Function to create Flex Carousel with interactive buttons
-def create_flex_carousel(products):
-    import urllib.parse
+def render_flex_carousel(products):
     bubbles = []
-    for i, product in enumerate(products):
-        # URL encode the product title to handle spaces and special characters
-        encoded_title = urllib.parse.quote(product['title'])
+    for product in products:
+        # Postbacks carry only the product ID (SKU); it is resolved through the product_key index
+        product_id = product_key(product)
         
         bubble = {
             "type": "bubble",
@@ -649,7 +1679,7 @@ def create_flex_carousel(products):
                 "url": product['image_url'],
                 "action": {
                     "type": "postback",
-                    "data": f"action=view_detail&product_id={i}&title={encoded_title}"
+                    "data": postback_data('view_detail', product_id)
                 }
             },
             "body": {
@@ -731,7 +1761,7 @@ def create_flex_carousel(products):
                         "action": {
                             "type": "postback",
                             "label": "📋 ดูรายละเอียด",
-                            "data": f"action=view_detail&product_id={i}&title={encoded_title}"
+                            "data": postback_data('view_detail', product_id)
                         }
                     },
                     {
@@ -740,7 +1770,7 @@ def create_flex_carousel(products):
                         "action": {
                             "type": "postback",
                             "label": "🛒 Add to Cart",
-                            "data": f"action=add_cart&product_id={i}&title={encoded_title}"
+                            "data": postback_data('add_cart', product_id)
                         }
                     }
                 ]
@@ -753,11 +1783,10 @@ def create_flex_carousel(products):
         "contents": bubbles
     }
 
-    return FlexSendMessage(alt_text="Product Catalog", contents=carousel)
+    return RenderedFlexMessage(alt_text="Product Catalog", contents=carousel)
 # Function to create detailed product card
-def create_detailed_product_card(product):
-    import urllib.parse
-    encoded_title = urllib.parse.quote(product['title'])
+def render_detailed_product_card(product):
+    product_id = product_key(product)
     
     detailed_card = {
         "type": "bubble",
@@ -895,7 +1924,7 @@ def create_detailed_product_card(product):
                     "action": {
                         "type": "postback",
                         "label": "🛒 เพิ่มในตะกร้า",
-                        "data": f"action=add_cart&title={encoded_title}"
+                        "data": postback_data('add_cart', product_id)
                     }
                 },
                 {
@@ -910,8 +1939,20 @@ def create_detailed_product_card(product):
             ]
         }
     }
+
+    # ปุ่ม "กลิ่นคล้ายกัน" เฉพาะสินค้าที่มีรายการแนะนำ
+    if similar_products.ready and get_similar_products(product):
+        detailed_card["footer"]["contents"].insert(1, {
+            "type": "button",
+            "style": "secondary",
+            "action": {
+                "type": "postback",
+                "label": "✨ กลิ่นคล้ายกัน",
+                "data": postback_data('similar', product_id)
+            }
+        })
     
-    return FlexSendMessage(alt_text=f"รายละเอียด {product['title']}", contents=detailed_card)
+    return RenderedFlexMessage(alt_text=f"รายละเอียด {product['title']}", contents=detailed_card)
 
 # Function to handle postback events
 def handle_postback_event(line_bot_api, event):
@@ -925,31 +1966,30 @@ def handle_postback_event(line_bot_api, event):
         print(f"User ID: {user_id}")
         print(f"Reply Token: {reply_token}")
         
-        # Parse postback data - improved parsing
-        params = {}
-        for param in data.split('&'):
-            if '=' in param:
-                key, value = param.split('=', 1)  # Split only on first '=' 
-                params[key] = value
-        
+        # Parse postback data: action=...&id=<SKU> (see postback_data)
+        params = dict(urllib.parse.parse_qsl(data))
         print(f"Parsed params: {params}")
-        
+
         action = params.get('action')
-        product_title = params.get('title', '')
-        
-        # URL decode the product title
-        import urllib.parse
-        decoded_title = urllib.parse.unquote(product_title)
-        
+        product_id = params.get('id')
+        if product_id is None and params.get('title'):
+            # Cards sent before postbacks carried IDs only have the title
+            match = product_catalog.snapshot.titles.resolve(params['title'])
+            product_id = match.product_key if match else None
+        product = product_catalog.snapshot.by_key.get(product_id)
+        product_title = product['title'] if product else params.get('title', product_id)
+
         print(f"Action: {action}")
-        print(f"Encoded Title: {product_title}")
-        print(f"Decoded Title: {decoded_title}")
-        
-        if action == 'view_detail':
-            print(f"Processing view_detail for: {decoded_title}")
+        print(f"Product: {product_id} ({product_title})")
+
+        if action in ('view_detail', 'similar', 'add_cart') and product_id is None:
+            line_bot_api.reply_message(reply_token, TextSendMessage(text="ขอโทษค่ะ ไม่พบสินค้าที่เลือก"))
+
+        elif action == 'view_detail':
+            print(f"Processing view_detail for: {product_id}")
             
-            # Get detailed product information
-            product_details = get_product_details_by_title(decoded_title)
+            # Get detailed product information (one product_key lookup)
+            product_details = get_product_details(product_id, product_title)
             print(f"Product details query result: {product_details}")
             
             if isinstance(product_details, dict):
@@ -960,34 +2000,54 @@ def handle_postback_event(line_bot_api, event):
                 print("Detailed card sent successfully")
                 
                 # Save interaction to chat history
-                bot_response = f"แสดงรายละเอียดสินค้า: {decoded_title}"
-                save_chat_history_with_relationship(user_id, f"ดูรายละเอียด {decoded_title}", bot_response)
+                bot_response = f"แสดงรายละเอียดสินค้า: {product_details['title']}"
+                save_chat_history_with_relationship(user_id, f"ดูรายละเอียด {product_details['title']}", bot_response)
             else:
-                print(f"Product not found: {decoded_title}")
-                error_message = f"ขอโทษค่ะ ไม่พบข้อมูลรายละเอียดของสินค้า '{decoded_title}'"
+                print(f"Product not found: {product_id}")
+                error_message = f"ขอโทษค่ะ ไม่พบข้อมูลรายละเอียดของสินค้า '{product_title}'"
                 line_bot_api.reply_message(
                     reply_token, 
                     TextSendMessage(text=error_message)
                 )
         
+        elif action == 'similar':
+            print(f"Processing similar for: {product_id}")
+
+            # Neighbour lists are keyed by product ID, so this needs no database call
+            similar = get_similar_products({'product_key': product_id})
+            if similar:
+                line_bot_api.reply_message(reply_token, [
+                    TextSendMessage(text=f"กลิ่นที่คล้ายกับ {product_title} ค่ะ: ✨"),
+                    create_flex_carousel(similar)
+                ])
+                bot_response = f"แนะนำกลิ่นคล้าย {product_title}"
+                save_chat_history_with_relationship(user_id, f"กลิ่นคล้ายกัน {product_title}", bot_response)
+            else:
+                line_bot_api.reply_message(
+                    reply_token,
+                    TextSendMessage(text=f"ขอโทษค่ะ ยังไม่มีกลิ่นที่คล้ายกับ '{product_title}'")
+                )
+
         elif action == 'add_cart':
-            print(f"Processing add_cart for: {decoded_title}")
-            
-            # Handle add to cart action
-            cart_message = f"✅ เพิ่ม '{decoded_title}' ลงในตะกร้าแล้วค่ะ!\n\n" \
-                          f"🛒 ดูตะกร้าสินค้า: /cart\n" \
-                          f"💳 สั่งซื้อ: /checkout\n" \
-                          f"🔍 ดูสินค้าอื่น: พิมพ์ 'แนะนำ'"
-            
-            line_bot_api.reply_message(reply_token, TextSendMessage(text=cart_message))
-            print("Add to cart message sent")
-            
-            # Save to cart in Neo4j
-            save_to_cart(user_id, decoded_title)
-            
-            # Save interaction to chat history
-            bot_response = f"เพิ่ม {decoded_title} ลงในตะกร้า"
-            save_chat_history_with_relationship(user_id, f"เพิ่มในตะกร้า {decoded_title}", bot_response)
+            print(f"Processing add_cart for: {product_id}")
+
+            # Save to cart in Neo4j (one write on the product_key index)
+            added_title = save_to_cart(user_id, product_id)
+            if added_title is None:
+                line_bot_api.reply_message(reply_token, TextSendMessage(text="ขอโทษค่ะ ไม่พบสินค้าที่เลือก"))
+            else:
+                # Handle add to cart action
+                cart_message = f"✅ เพิ่ม '{added_title}' ลงในตะกร้าแล้วค่ะ!\n\n" \
+                              f"🛒 ดูตะกร้าสินค้า: /cart\n" \
+                              f"💳 สั่งซื้อ: /checkout\n" \
+                              f"🔍 ดูสินค้าอื่น: พิมพ์ 'แนะนำ'"
+
+                line_bot_api.reply_message(reply_token, TextSendMessage(text=cart_message))
+                print("Add to cart message sent")
+
+                # Save interaction to chat history
+                bot_response = f"เพิ่ม {added_title} ลงในตะกร้า"
+                save_chat_history_with_relationship(user_id, f"เพิ่มในตะกร้า {added_title}", bot_response)
         
         else:
             print(f"Unknown action: {action}")
@@ -1008,17 +2068,18 @@ def handle_postback_event(line_bot_api, event):
         except Exception as reply_error:
             print(f"Reply error: {reply_error}")
 
-# Function to save item to cart in Neo4j
-def save_to_cart(user_id, product_title):
+# Function to save item to cart in Neo4j; returns the product title, or None if the ID is unknown
+def save_to_cart(user_id, product_id):
     query = '''
+    MATCH (p:Product {product_key: $product_id})
     MERGE (u:User {user_id: $user_id})
-    MATCH (p:Product {title: $product_title})
     MERGE (u)-[r:ADDED_TO_CART]->(p)
     ON CREATE SET r.timestamp = datetime(), r.quantity = 1
     ON MATCH SET r.timestamp = datetime(), r.quantity = r.quantity + 1
+    RETURN p.title AS title
     '''
-    with graph.session() as session:
-        session.run(query, user_id=user_id, product_title=product_title)
+    result = graph.write(query, user_id=user_id, product_id=product_id)
+    return result[0]['title'] if result else None
 
 # Function to get user's cart
 def get_user_cart(user_id):
@@ -1028,11 +2089,25 @@ def get_user_cart(user_id):
            r.quantity AS quantity, r.timestamp AS added_time
     ORDER BY r.timestamp DESC
     '''
-    with graph.session() as session:
-        result = session.run(query, user_id=user_id).data()
-    return result
+    return graph.read_own_writes(query, user_id=user_id)
+
+PRODUCT_INTENTS = ['product_bestseller', 'product_new', 'product_reviewed', 'product_limited',
+                   'scent_fresh', 'scent_sweet', 'scent_sexy',
+                   'season_summer', 'season_winter',
+                   'occasion_work', 'occasion_date', 'occasion_party']
 
 # Enhanced message handler with cart commands
+def reply_product_details(line_bot_api, tk, user_id, msg):
+    """Detailed card for the product the user named (the text goes through the title resolver)"""
+    product_details = get_product_details_by_title(msg)
+    if isinstance(product_details, dict):
+        line_bot_api.reply_message(tk, create_detailed_product_card(product_details))
+        bot_response = f"แสดงรายละเอียดสินค้า: {msg}"
+    else:
+        bot_response = product_details
+        line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
+    save_chat_history_with_relationship(user_id, msg, bot_response)
+
 def return_message(line_bot_api, tk, user_id, msg):
     # Handle special commands
     if msg.lower() == '/cart' or msg == 'ตะกร้า':
@@ -1080,26 +2155,36 @@ def return_message(line_bot_api, tk, user_id, msg):
         MATCH (u:User {user_id: $user_id})-[r:ADDED_TO_CART]->()
         DELETE r
         '''
-        with graph.session() as session:
-            session.run(clear_cart_query, user_id=user_id)
+        graph.write(clear_cart_query, user_id=user_id)
         
         line_bot_api.reply_message(tk, TextSendMessage(text="🗑️ ล้างตะกร้าสินค้าเรียบร้อยแล้วค่ะ"))
         save_chat_history_with_relationship(user_id, msg, "ล้างตะกร้าสินค้า")
         return
 
+    # A product name or alias is never an intent: answer it before classification
+    if product_catalog.snapshot.titles.lookup(msg):
+        reply_product_details(line_bot_api, tk, user_id, msg)
+        return
+
     # Apply text normalization first
     normalized_msg = text_normalizer.normalize_text(msg)
     print(f"Original message: {msg}")
     print(f"Normalized message: {normalized_msg}")
     
+    # Embedded only if a semantic step needs it, and then only once
+    message_embedding = MessageEmbedding(msg)
+
     # Try keyword-based intent extraction first
-    keyword_intent, keyword_score = text_normalizer.extract_intent_from_text(msg)
+    intent_scores = text_normalizer.score_intents(normalized_msg)
+    keyword_intent, keyword_score = text_normalizer.best_intent(intent_scores)
     print(f"Keyword intent: {keyword_intent}, Score: {keyword_score}")
     
     # Predict intent using ML classifier with normalized text
+    keyword_used = False
     try:
-        predicted_intent = intent_classifier.predict([normalized_msg])[0]
-        confidence = max(intent_classifier.predict_proba([normalized_msg])[0])
+        prediction = predict_intent(msg)
+        predicted_intent = prediction.intent
+        confidence = prediction.confidence
         
         print(f"ML predicted intent: {predicted_intent}, Confidence: {confidence}")
         
@@ -1107,26 +2192,53 @@ def return_message(line_bot_api, tk, user_id, msg):
         if keyword_score >= 1 and confidence < 0.8:
             final_intent = keyword_intent
             final_confidence = keyword_score / len(text_normalizer.intent_keywords.get(keyword_intent, []))
+            keyword_used = True
             print(f"Using keyword intent: {final_intent}")
         else:
             final_intent = predicted_intent
             final_confidence = confidence
             print(f"Using ML intent: {final_intent}")
-        
-        # If both confidence is low, fall back to basic FAISS
-        if final_confidence < 0.5:
-            chk_msg = check_sentence_basic(msg)
-            if chk_msg[0] == "สวัสดี":
-                bot_response = chk_msg[1]
-                line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
-                save_chat_history_with_relationship(user_id, msg, bot_response)
-                return
-                
+
     except Exception as e:
         print(f"Intent classification error: {e}")
         final_intent = "unknown"
         final_confidence = 0.0
 
+    # The classifier always answers with one of its labels; only a keyword hit or a confident
+    # prediction is trusted, anything else is a guess
+    intent_trusted = keyword_used or final_confidence >= 0.5
+
+    # Partial names and typos ('วู้ดเสด', 'myrh and tonka') come before the FAQ fallback
+    if not intent_trusted and product_catalog.snapshot.titles.resolve(msg):
+        reply_product_details(line_bot_api, tk, user_id, msg)
+        return
+
+    # If both confidence is low, fall back to the nearest FAQ question or intent example
+    if final_confidence < 0.5:
+        faq_match = match_faq(message_embedding)
+        if faq_match is not None:
+            print(f"Nearest example: '{faq_match.text}' ({faq_match.intent}, {faq_match.score:.2f})")
+            if faq_match.answer:
+                bot_response = faq_match.answer
+                line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
+                save_chat_history_with_relationship(user_id, msg, bot_response)
+                return
+            final_intent = faq_match.intent
+            final_confidence = faq_match.score
+            intent_trusted = True
+        elif not intent_trusted:
+            # Only the classifier's guess is left: search products by meaning instead of trusting it
+            print(f"Ignoring low-confidence intent {final_intent}, using semantic search")
+            final_intent = 'semantic_search'
+
+    # ราคา / ขนาด / เรตติ้งในข้อความ: ใช้ร่วมกับ intent สินค้าเฉพาะเมื่อ intent นั้นเชื่อถือได้
+    # ไม่อย่างนั้นให้ค้นตามเงื่อนไขอย่างเดียว ('rating >= 4.5' ไม่ใช่ scent_fresh)
+    product_filters = parse_product_filters(msg)
+    if product_filters:
+        print(f"Product filters: {product_filters}")
+        if not (intent_trusted and final_intent in PRODUCT_INTENTS):
+            final_intent = 'product_filter'
+
     bot_response = ""
 
     # Handle different intents
@@ -1144,14 +2256,21 @@ def return_message(line_bot_api, tk, user_id, msg):
         ]
         quick_reply_buttons = QuickReply(items=quick_reply_items)
         bot_response = get_intent_response_message(final_intent)
-        line_bot_api.reply_message(tk, TextSendMessage(text=bot_response, quick_reply=quick_reply_buttons))
+        personal_products = get_personal_recommendations(user_id)
+        if personal_products:
+            # Quick reply ต้องอยู่ที่ข้อความสุดท้าย (carousel จาก cache ใช้ร่วมกัน จึงแก้ไขไม่ได้)
+            line_bot_api.reply_message(tk, [
+                TextSendMessage(text='แนะนำสำหรับคุณโดยเฉพาะจากสินค้าที่คุณสนใจค่ะ: 💝'),
+                create_flex_carousel(personal_products),
+                TextSendMessage(text=bot_response, quick_reply=quick_reply_buttons)
+            ])
+            bot_response = f"{bot_response} (ส่งสินค้าแนะนำส่วนตัว {len(personal_products)} รายการ)"
+        else:
+            line_bot_api.reply_message(tk, TextSendMessage(text=bot_response, quick_reply=quick_reply_buttons))
         
-    elif final_intent in ['product_bestseller', 'product_new', 'product_reviewed', 'product_limited',
-                         'scent_fresh', 'scent_sweet', 'scent_sexy', 
-                         'season_summer', 'season_winter',
-                         'occasion_work', 'occasion_date', 'occasion_party']:
+    elif final_intent in PRODUCT_INTENTS or final_intent == 'product_filter':
         
-        products = search_products_by_intent(final_intent, normalized_msg)
+        products = search_products_by_intent(final_intent, product_filters)
         
         if products:
             response_message = get_intent_response_message(final_intent)
@@ -1167,99 +2286,376 @@ def return_message(line_bot_api, tk, user_id, msg):
             bot_response = f"ขอโทษค่ะ ไม่พบสินค้าที่ตรงกับ '{msg}' ลองใช้คำค้นหาอื่นดูค่ะ"
             line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
     
-    # Check if message is a specific product title
-    elif msg in corpus:
-        product_details = get_product_details_by_title(msg)
-        if isinstance(product_details, dict):
-            detailed_card = create_detailed_product_card(product_details)
-            line_bot_api.reply_message(tk, detailed_card)
-            bot_response = f"แสดงรายละเอียดสินค้า: {msg}"
-        else:
-            bot_response = product_details
-            line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
-    
     else:
-        # Suggest similar terms based on normalized text
-        suggestions = []
-        for intent_name, keywords in text_normalizer.intent_keywords.items():
-            for keyword in keywords:
-                if keyword in normalized_msg:
-                    suggestions.append(get_intent_response_message(intent_name))
-                    break
-        
-        if suggestions:
-            bot_response = f"คุณหมายถึง: {', '.join(suggestions[:2])} ใช่ไหมคะ?"
+        # semantic_search / unknown: try semantic product search before giving up
+        semantic_products = search_products_semantic(message_embedding)
+        if semantic_products:
+            response_message = 'สินค้าที่ใกล้เคียงกับที่คุณถามค่ะ: 🔍'
+            line_bot_api.reply_message(tk, [
+                TextSendMessage(text=response_message),
+                create_flex_carousel(semantic_products)
+            ])
+            bot_response = f"{response_message} (ส่ง Flex Message แสดง {len(semantic_products)} รายการ)"
         else:
-            bot_response = "ขอโทษค่ะ ฉันไม่เข้าใจคำถามของคุณ\nลองถาม 'แนะนำ perfume' หรือ 'ขอ review ดีๆ' ดูค่ะ 😊\n\nหรือดูตะกร้าสินค้า: /cart"
+            # Suggest similar terms based on normalized text
+            suggestions = [get_intent_response_message(intent_name) for intent_name in intent_scores]
+
+            if suggestions:
+                bot_response = f"คุณหมายถึง: {', '.join(suggestions[:2])} ใช่ไหมคะ?"
+            else:
+                bot_response = "ขอโทษค่ะ ฉันไม่เข้าใจคำถามของคุณ\nลองถาม 'แนะนำ perfume' หรือ 'ขอ review ดีๆ' ดูค่ะ 😊\n\nหรือดูตะกร้าสินค้า: /cart"
         
-        line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
+            line_bot_api.reply_message(tk, TextSendMessage(text=bot_response))
 
     save_chat_history_with_relationship(user_id, msg, bot_response)
 
-# Basic FAISS check function for fallback
-def check_sentence_basic(msg):
-    search_vector = encoder.encode(msg)
-    _vector = np.array([search_vector])
-    faiss.normalize_L2(_vector)
-    distances, ann = basic_index.search(_vector, k=1)
-    if distances[0][0] <= 0.4:
-        category = basic_df['category'][ann[0][0]]
-        sentence = basic_df['text'][ann[0][0]]
-    else:
-        category = msg
-        sentence = msg
-    return [sentence, category]
+# Chat history is written by a background worker in UNWIND batches, off the reply path
+CHAT_HISTORY_QUEUE_SIZE = int(os.environ.get('CHAT_HISTORY_QUEUE_SIZE', '10000'))
+CHAT_HISTORY_BATCH_SIZE = int(os.environ.get('CHAT_HISTORY_BATCH_SIZE', '200'))
+CHAT_HISTORY_FLUSH_SECONDS = float(os.environ.get('CHAT_HISTORY_FLUSH_SECONDS', '1.0'))
+CHAT_HISTORY_PUT_TIMEOUT = 0.05  # how long a full queue may hold up a reply before the entry is dropped
+
+CHAT_HISTORY_QUERY = """
+UNWIND $rows AS row
+MERGE (u:User {user_id: row.user_id})
+CREATE (um:UserMessage {message: row.user_message, timestamp: datetime({epochMillis: row.timestamp})})
+CREATE (bm:BotMessage {message: row.bot_message, timestamp: datetime({epochMillis: row.timestamp})})
+MERGE (u)-[:SENT]->(um)
+MERGE (bm)-[:REPLIED_WITH]->(u)
+"""
+
+class ChatHistoryWriter:
+    """Bounded queue + one worker thread that flushes on batch size or after flush_interval"""
+    _stop = object()
+
+    def __init__(self, max_queue=CHAT_HISTORY_QUEUE_SIZE, batch_size=CHAT_HISTORY_BATCH_SIZE,
+                 flush_interval=CHAT_HISTORY_FLUSH_SECONDS):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._worker = None
+        self._closed = False
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.max_depth = 0
+        self.last_flush_seconds = 0.0
+
+    def start(self):
+        with self._lock:
+            if self._worker is None and not self._closed:
+                self._worker = threading.Thread(target=self._run, name='chat-history-writer', daemon=True)
+                self._worker.start()
+
+    def submit(self, user_id, user_message, bot_message):
+        if self._closed:
+            self.dropped += 1
+            return False
+        self.start()
+        row = {'user_id': user_id, 'user_message': user_message, 'bot_message': bot_message,
+               'timestamp': int(time.time() * 1000)}
+        try:
+            self._queue.put(row, timeout=CHAT_HISTORY_PUT_TIMEOUT)
+        except queue.Full:
+            self.dropped += 1
+            print(f"Chat history queue full, dropped message from {user_id}")
+            return False
+        self.enqueued += 1
+        self.max_depth = max(self.max_depth, self._queue.qsize())
+        return True
+
+    def stats(self):
+        return {'queue_depth': self._queue.qsize(), 'queue_capacity': self._queue.maxsize,
+                'max_depth': self.max_depth, 'enqueued': self.enqueued, 'written': self.written,
+                'dropped': self.dropped, 'failed': self.failed, 'batches': self.batches,
+                'last_flush_seconds': self.last_flush_seconds}
+
+    def _run(self):
+        while True:
+            batch = []
+            stopping = False
+            deadline = time.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                try:
+                    row = self._queue.get(timeout=max(0.0, deadline - time.time()))
+                except queue.Empty:
+                    break
+                if row is self._stop:
+                    stopping = True
+                    break
+                batch.append(row)
+            if batch:
+                self._flush(batch)
+            if stopping:
+                return
+
+    def _flush(self, batch):
+        started = time.time()
+        try:
+            graph.write(CHAT_HISTORY_QUERY, rows=batch)
+            self.written += len(batch)
+            self.batches += 1
+        except Exception as e:
+            self.failed += len(batch)
+            print(f"Chat history flush error ({len(batch)} messages): {e}")
+        self.last_flush_seconds = time.time() - started
+
+    def close(self, timeout=10.0):
+        """Stop accepting messages and flush everything already queued"""
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            worker = self._worker
+        if worker is None:
+            return
+        self._queue.put(self._stop)
+        worker.join(timeout)
+        if worker.is_alive():
+            print(f"Chat history writer did not drain within {timeout}s: {self._queue.qsize()} messages left")
+        else:
+            print(f"Chat history writer drained: {self.written} written, {self.dropped} dropped, {self.failed} failed")
+
+chat_history_writer = ChatHistoryWriter()
+atexit.register(chat_history_writer.close)
 
 def save_chat_history_with_relationship(user_id, user_message, bot_message):
-    query = '''
-    MERGE (u:User {user_id: $user_id})
-    CREATE (um:UserMessage {message: $user_message, timestamp: datetime()})
-    CREATE (bm:BotMessage {message: $bot_message, timestamp: datetime()})
-    MERGE (u)-[:SENT]->(um)
-    MERGE (bm)-[:REPLIED_WITH]->(u)
-    '''
-    with graph.session() as session:
-        session.run(query, user_id=user_id, user_message=user_message, bot_message=bot_message)
+    chat_history_writer.submit(user_id, user_message, bot_message)
+
+# Loaded in this order by the background warm-up; the app is ready once all of them are
+STARTUP_RESOURCES = [graph, catalog_loader, encoder, embedding_store,
+                     intent_classifier, intent_faq_index, product_index, similar_products,
+                     user_recommendations]
+_warmup_started = threading.Event()
+WARMUP_RETRY_SECONDS = float(os.environ.get('WARMUP_RETRY_SECONDS', '1'))  # first retry delay, doubled each time
+WARMUP_RETRY_MAX_SECONDS = float(os.environ.get('WARMUP_RETRY_MAX_SECONDS', '60'))
+
+def start_background_init():
+    """Start loading every heavy resource in a background thread (safe to call repeatedly)"""
+    if _warmup_started.is_set():
+        return
+    _warmup_started.set()
+
+    def warm_up():
+        failed = [resource for resource in STARTUP_RESOURCES if not resource.preload()]
+        product_catalog.start_auto_refresh()
+        # A dependency that was down at boot (e.g. Neo4j) must not leave /ready at 503 forever
+        delay = WARMUP_RETRY_SECONDS
+        while failed:
+            print(f"Retrying {', '.join(r.resource_name for r in failed)} in {delay:g}s")
+            time.sleep(delay)
+            delay = min(delay * 2, WARMUP_RETRY_MAX_SECONDS)
+            failed = [resource for resource in failed if not resource.preload()]
+
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
 
 # Initialize Flask app
 app = Flask(__name__)
 
-# Enhanced Flask webhook handler
+@app.before_request
+def ensure_warmup():
+    start_background_init()
+
+# Liveness: the process is up and serving HTTP
+@app.route("/healthz", methods=['GET'])
+def healthz():
+    return jsonify({'status': 'ok'})
+
+# Route bodies shared by the Flask app below and the ASGI app in asgi.py: (payload, HTTP status)
+def readiness_status():
+    resources = {resource.resource_name: resource.status() for resource in STARTUP_RESOURCES}
+    is_ready = all(resource.ready for resource in STARTUP_RESOURCES)
+    return {'status': 'ready' if is_ready else 'starting', 'resources': resources}, 200 if is_ready else 503
+
+def metrics_status():
+    return {'chat_history': chat_history_writer.stats(),
+            'webhook_pending_events': event_dispatcher.pending(),
+            'flex_cache': {'size': len(flex_cache._messages), 'hits': flex_cache.hits,
+                           'misses': flex_cache.misses}}, 200
+
+def refresh_catalog_status(token):
+    if not CATALOG_REFRESH_TOKEN:
+        return {'status': 'not found'}, 404
+    if not hmac.compare_digest(token.encode('utf-8'), CATALOG_REFRESH_TOKEN.encode('utf-8')):
+        return {'status': 'forbidden'}, 403
+    snapshot = product_catalog.refresh(force=True)
+    return {'status': 'ok', 'products': len(snapshot.products), 'version': snapshot.version,
+            'loaded_at': snapshot.loaded_at}, 200
+
+# Readiness: every heavy resource has finished loading
+@app.route("/ready", methods=['GET'])
+def ready():
+    payload, status = readiness_status()
+    return jsonify(payload), status
+
+# Background-writer backpressure and cache counters
+@app.route("/metrics", methods=['GET'])
+def metrics():
+    payload, status = metrics_status()
+    return jsonify(payload), status
+
+# On-demand catalog refresh (e.g. right after imprt_neo4j.py has run)
+@app.route("/catalog/refresh", methods=['POST'])
+def refresh_catalog():
+    payload, status = refresh_catalog_status(request.headers.get('X-Refresh-Token', ''))
+    return jsonify(payload), status
+
+# Webhook events run on a worker pool; events of the same user run one at a time, in delivery order
+WEBHOOK_WORKERS = int(os.environ.get('WEBHOOK_WORKERS', '8'))
+REPLY_TOKEN_SECONDS = 60  # LINE reply tokens expire about a minute after the event
+
+class EventDispatcher:
+    """Fans events out to a thread pool while keeping each user's events sequential"""
+    def __init__(self, workers=WEBHOOK_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='webhook')
+        self._pending = {}  # user key -> deque of callables still to run for that user
+        self._lock = threading.Lock()
+
+    def submit(self, user_key, task):
+        with self._lock:
+            if user_key in self._pending:
+                # A worker is already running this user's events; it will pick this one up next
+                self._pending[user_key].append(task)
+                return
+            self._pending[user_key] = deque([task])
+        self._executor.submit(self._drain, user_key)
+
+    def _drain(self, user_key):
+        while True:
+            with self._lock:
+                tasks = self._pending[user_key]
+                if not tasks:
+                    del self._pending[user_key]
+                    return
+                task = tasks.popleft()
+            try:
+                task()
+            except Exception as e:
+                print(f"Webhook event error for {user_key}: {e}")
+
+    def pending(self):
+        with self._lock:
+            return sum(len(tasks) for tasks in self._pending.values())
+
+event_dispatcher = EventDispatcher()
+
+def event_user_key(event):
+    source = event.get('source', {})
+    return source.get('userId') or source.get('groupId') or source.get('roomId') or 'anonymous'
+
+# LINE API clients, created once per process; replies reuse keep-alive connections from the pool
+LINE_CHANNEL_ACCESS_TOKEN = os.environ.get('LINE_CHANNEL_ACCESS_TOKEN', '')
+LINE_CHANNEL_SECRET = os.environ.get('LINE_CHANNEL_SECRET', '')
+LINE_API_ENDPOINT = os.environ.get('LINE_API_ENDPOINT', LineBotApi.DEFAULT_API_ENDPOINT)  # a local stub for benchmarks
+LINE_HTTP_POOL_SIZE = int(os.environ.get('LINE_HTTP_POOL_SIZE', str(WEBHOOK_WORKERS)))
+LINE_HTTP_TIMEOUT = float(os.environ.get('LINE_HTTP_TIMEOUT', '5'))
+
+class PooledRequestsHttpClient(RequestsHttpClient):
+    """RequestsHttpClient on one requests.Session, so TCP/TLS connections are kept alive and reused"""
+    def __init__(self, timeout=LINE_HTTP_TIMEOUT, pool_size=LINE_HTTP_POOL_SIZE):
+        super().__init__(timeout)
+        self.session = requests.Session()
+        # One connection per webhook worker; block instead of opening throwaway extra connections
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=pool_size, pool_block=True)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def get(self, url, headers=None, params=None, stream=False, timeout=None):
+        response = self.session.get(url, headers=headers, params=params, stream=stream,
+                                    timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+    def post(self, url, headers=None, data=None, timeout=None):
+        response = self.session.post(url, headers=headers, data=data,
+                                     timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+    def delete(self, url, headers=None, data=None, timeout=None):
+        response = self.session.delete(url, headers=headers, data=data,
+                                       timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+    def put(self, url, headers=None, data=None, timeout=None):
+        response = self.session.put(url, headers=headers, data=data,
+                                    timeout=timeout if timeout is not None else self.timeout)
+        return RequestsHttpResponse(response)
+
+def create_line_bot_api(access_token=LINE_CHANNEL_ACCESS_TOKEN, endpoint=LINE_API_ENDPOINT,
+                        pool_size=LINE_HTTP_POOL_SIZE, pooled=True):
+    if not pooled:
+        return LineBotApi(access_token, endpoint=endpoint, timeout=LINE_HTTP_TIMEOUT)
+    http_client = functools.partial(PooledRequestsHttpClient, pool_size=pool_size)
+    return LineBotApi(access_token, endpoint=endpoint, timeout=LINE_HTTP_TIMEOUT, http_client=http_client)
+
+if not LINE_CHANNEL_ACCESS_TOKEN or not LINE_CHANNEL_SECRET:
+    print("LINE_CHANNEL_ACCESS_TOKEN / LINE_CHANNEL_SECRET not set, replies will fail and every webhook will be rejected")
+line_bot_api = create_line_bot_api()
+webhook_handler = WebhookHandler(LINE_CHANNEL_SECRET)
+
+def valid_signature(body, signature):
+    # Fail closed: without the channel secret no request can be verified, so none is accepted
+    if not LINE_CHANNEL_SECRET:
+        print("LINE_CHANNEL_SECRET not set, rejecting webhook")
+        return False
+    return webhook_handler.parser.signature_validator.validate(body, signature)
+
+class ReplyRecorder:
+    """Stands in for LineBotApi so the handlers can run without doing HTTP; asgi.py sends the replies"""
+    def __init__(self):
+        self.replies = []
+
+    def reply_message(self, reply_token, messages, notification_disabled=False, timeout=None):
+        if not isinstance(messages, (list, tuple)):
+            messages = [messages]
+        self.replies.append((reply_token, list(messages)))
+
+# Create event object for postback
+class PostbackEventObj:
+    def __init__(self, data):
+        self.postback = type('obj', (object,), {'data': data['postback']['data']})
+        self.source = type('obj', (object,), {'user_id': data['source']['userId']})
+        self.reply_token = data['replyToken']
+
+def handle_webhook_event(line_bot_api, event):
+    age = time.time() - event.get('timestamp', time.time() * 1000) / 1000
+    if age > REPLY_TOKEN_SECONDS:
+        print(f"Event waited {age:.1f}s, its reply token has probably expired")
+
+    # Handle different event types
+    if event.get('type') == 'message' and event.get('message', {}).get('type') == 'text':
+        msg = event['message']['text']
+        user_id = event['source']['userId']
+        tk = event['replyToken']
+        return_message(line_bot_api, tk, user_id, msg)
+
+    elif event.get('type') == 'postback':
+        postback_event = PostbackEventObj(event)
+        handle_postback_event(line_bot_api, postback_event)
+
+# Enhanced Flask webhook handler: acknowledge at once, reply from the worker pool
 @app.route("/", methods=['POST'])
 def linebot():
     body = request.get_data(as_text=True)
+    signature = request.headers.get('X-Line-Signature', '')
+    if not valid_signature(body, signature):
+        print("Webhook rejected: invalid X-Line-Signature")
+        return 'Invalid signature', 400
     try:
         json_data = json.loads(body)
-        access_token = 'kcKoDOsKhahBSiDnrbZTdizLgnwEXsOy2vmdJ/Lpti6eg+2RDPKORbdEGR9zizzLs7kcO1UZa36xWYlQcrIt6WW5sbjWMmAh0SSsW0RK8jF6se6/cLQ3a70+c5pIpjjYe82X3O7VcmH7grDA87DgBAdB04t89/1O/w1cDnyilFU='
-        secret = 'e44afc0c53a055472793d01e2a0552a6'
-        line_bot_api = LineBotApi(access_token)
-        handler = WebhookHandler(secret)
-        signature = request.headers.get('X-Line-Signature', '')
-        
-        # Handle different event types
-        if json_data.get('events'):
-            event = json_data['events'][0]
-            
-            if event.get('type') == 'message' and event.get('message', {}).get('type') == 'text':
-                msg = event['message']['text']
-                user_id = event['source']['userId']
-                tk = event['replyToken']
-                return_message(line_bot_api, tk, user_id, msg)
-                
-            elif event.get('type') == 'postback':
-                # Create event object for postback
-                class PostbackEventObj:
-                    def __init__(self, data):
-                        self.postback = type('obj', (object,), {'data': data['postback']['data']})
-                        self.source = type('obj', (object,), {'user_id': data['source']['userId']})
-                        self.reply_token = data['replyToken']
-                
-                postback_event = PostbackEventObj(event)
-                handle_postback_event(line_bot_api, postback_event)
-                
+
+        for event in json_data.get('events', []):
+            event_dispatcher.submit(event_user_key(event),
+                                    functools.partial(handle_webhook_event, line_bot_api, event))
+
     except Exception as e:
         print(f"Webhook error: {e}")
     return 'OK'
 
 if __name__ == '__main__':
+    # SIGTERM -> normal exit so atexit drains the chat history queue
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    start_background_init()
     app.run(port=5000)
\ No newline at end of file
@@ -0,0 +1,11 @@
+import argparse
+
+import main
+
+parser = argparse.ArgumentParser(description="Train the intent classifier and write the versioned model artifact")
+parser.add_argument('--output', default=main.INTENT_MODEL_PATH, help="artifact path: <path>.meta.json points at the model, "
+                                                                       "written as <path>.<checksum>")
+args = parser.parse_args()
+
+classifier = main.write_intent_model_artifact(args.output)
+print(f"Intent model saved: {len(main.normalized_intent_data)} examples, {len(classifier.classes_)} intents -> {args.output}")